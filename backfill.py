@@ -0,0 +1,344 @@
+"""Offline rebuild of the daily report workbooks and rollups from persisted state.
+
+Completed activities are kept in the user states and, after midnight, in the
+daily archive, independently of the per-group activity logs the reports are
+built from. If a log write was lost, that day's report has holes even though
+the activities still exist. This tool:
+1. Reads every persisted activity of a date range in one pass (the user states plus the archive days).
+2. Turns them into report rows with vectorized pandas operations.
+3. Appends the rows missing from each group's log.
+4. Rebuilds each (group, day) workbook and rollup in a pool of worker processes.
+5. Verifies that the row counts of the workbook and the rollup match the source.
+
+Run it in the bot's working directory while the bot is stopped:
+
+    python backfill.py --from 2026-10-01 --to 2026-10-16
+    python backfill.py --from 01/10/2026 --to 16/10/2026 --group -1001234567890 --dry-run
+
+A day belongs to the date of the check-out in REPORT_TIMEZONE, as in
+record_activity. A row that is already in the log of the day before or after
+(written while the bot dated check-outs with the server's clock) is not
+added again.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Columns that identify one activity when comparing the source with the logs
+ROW_KEY = ['ID Nhóm', 'ID', 'Thời gian bắt đầu']
+
+
+def naive(bot, value):
+    """Parse a stored timestamp as naive wall time in REPORT_TIMEZONE, as record_activity stores it."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(bot.REPORT_TIMEZONE).replace(tzinfo=None)
+    return value
+
+
+def shift_date(date_str, days):
+    """Move a YYYYMMDD date by a number of days."""
+    return (datetime.strptime(date_str, "%Y%m%d") + timedelta(days=days)).strftime("%Y%m%d")
+
+
+def source_activities(bot, start_date, end_date):
+    """Return (user_id, activity) pairs of every persisted activity that may end in the range.
+
+    The archive is split by start date, so the day before the range is read
+    too, for activities that ran past midnight.
+    """
+    entries = {}
+    day = start_date - timedelta(days=1)
+    while day <= end_date:
+        for user_id, activity in bot.load_archived_activities(day.strftime("%Y%m%d")):
+            entries.setdefault((user_id, str(activity['start_time'])), (user_id, activity))
+        day += timedelta(days=1)
+    for user_id, state in bot.user_states.items():
+        for activity in state['activities']:
+            entries.setdefault((user_id, str(activity['start_time'])), (user_id, activity))
+    return list(entries.values())
+
+
+def source_frame(bot, entries, start_str, end_str):
+    """Build the report rows of the source activities in one vectorized pass.
+
+    Returns (frame, unattributed), where the frame has EXCEL_COLUMNS plus the
+    report day in '_date' and unattributed counts activities without a group.
+    """
+    if not entries:
+        return pd.DataFrame(columns=bot.EXCEL_COLUMNS + ['_date']), 0
+    df = pd.DataFrame({
+        'ID Nhóm': [activity.get('group_id') for _, activity in entries],
+        'ID': [int(user_id) for user_id, _ in entries],
+        'Tên': [activity.get('full_name') or activity.get('username') for _, activity in entries],
+        'Hành động': [activity.get('action') for _, activity in entries],
+        'Thời gian bắt đầu': pd.to_datetime([naive(bot, activity['start_time']) for _, activity in entries]),
+        'Thời gian kết thúc': pd.to_datetime([naive(bot, activity['end_time']) for _, activity in entries]),
+        'Tổng thời gian (phút)': pd.to_numeric([activity.get('duration') for _, activity in entries], errors='coerce'),
+    })
+    df['_date'] = df['Thời gian kết thúc'].dt.strftime("%Y%m%d")
+    # Rows of the days next to the range may be filed under a day of the range
+    df = df[(df['_date'] >= shift_date(start_str, -1)) & (df['_date'] <= shift_date(end_str, 1))]
+    # Activities recorded before group IDs were kept cannot be placed in a report
+    in_range = (df['_date'] >= start_str) & (df['_date'] <= end_str)
+    unattributed = int((df['ID Nhóm'].isna() & in_range).sum())
+    df = df[df['ID Nhóm'].notna()].astype({'ID Nhóm': 'int64'})
+
+    limits = df['Hành động'].map(bot.TIME_LIMITS)
+    violation = df['Tổng thời gian (phút)'] > limits
+    df['Thời gian cho phép (phút)'] = limits.fillna(0)
+    df['Vi phạm'] = np.where(violation, 'Có', 'Không')
+    df['Thời gian vi phạm (phút)'] = np.where(violation, df['Tổng thời gian (phút)'] - limits, 0)
+    return df[bot.EXCEL_COLUMNS + ['_date']].reset_index(drop=True), unattributed
+
+
+def stored_rows(bot, group_id, date_str):
+    """Return a group's stored report rows for a day, including a legacy workbook's rows."""
+    rows = bot.query_group_activities(group_id, date_str)
+    if not rows and bot.sqlite_storage is None:
+        excel_filename = bot.get_group_excel_filename(group_id, date_str)
+        if os.path.exists(excel_filename):
+            rows = bot.read_excel_rows(group_id, excel_filename)
+    return rows
+
+
+def key_frame(rows):
+    """ROW_KEY columns of stored rows, with parsed start times."""
+    keys = pd.DataFrame([[row.get(column) for column in ROW_KEY] for row in rows], columns=ROW_KEY)
+    keys['Thời gian bắt đầu'] = pd.to_datetime(keys['Thời gian bắt đầu'], format='ISO8601')
+    return keys.astype({'ID Nhóm': 'int64', 'ID': 'int64'})
+
+
+def log_row(bot, row):
+    """Convert a source frame row to the dict record_activity writes."""
+    data = {column: row[column] for column in bot.EXCEL_COLUMNS}
+    data['Thời gian bắt đầu'] = row['Thời gian bắt đầu'].isoformat()
+    data['Thời gian kết thúc'] = row['Thời gian kết thúc'].isoformat()
+    for column in ('ID Nhóm', 'ID'):
+        data[column] = int(data[column])
+    for column in bot.REPORT_NUMERIC_COLUMNS:
+        data[column] = float(data[column])
+    return data
+
+
+def stored_dates(source, stored):
+    """Return the day each source row is filed under.
+
+    That is the row's own day, unless the row is only stored in the log of
+    the day before or after. `stored` maps dates to a group's stored rows.
+    """
+    keys = [key_frame(rows).assign(_stored=date_str) for date_str, rows in stored.items() if rows]
+    if source.empty or not keys:
+        return source['_date']
+    keys = pd.concat(keys).drop_duplicates()
+    merged = source[ROW_KEY + ['_date']].reset_index().merge(keys, on=ROW_KEY, how='left')
+    offset = (pd.to_datetime(merged['_stored'], format="%Y%m%d")
+              - pd.to_datetime(merged['_date'], format="%Y%m%d")).dt.days.abs()
+    # 0: stored in its own day, 1: in a neighbouring day, 2: not stored nearby
+    merged['_rank'] = np.select([offset == 0, offset == 1], [0, 1], 2)
+    best = merged.sort_values('_rank', kind='stable').drop_duplicates('index').set_index('index')
+    return best['_stored'].where(best['_rank'] < 2, best['_date']).reindex(source.index)
+
+
+def plan_days(bot, source, groups, dates):
+    """Compare the source with the stored rows of each (group, day).
+
+    Returns a list of dicts with the stored rows, the rows missing from the
+    store and the number of source rows.
+    """
+    by_group = dict(iter(source.groupby('ID Nhóm', sort=False)))
+    empty = source.iloc[0:0]
+    padded = [shift_date(dates[0], -1)] + dates + [shift_date(dates[-1], 1)]
+    plans = []
+    for group_id in groups:
+        stored = {date_str: stored_rows(bot, group_id, date_str) for date_str in padded}
+        group_source = by_group.get(group_id, empty)
+        group_source = group_source.assign(_date=stored_dates(group_source, stored))
+        by_day = dict(iter(group_source.groupby('_date', sort=False)))
+        for date_str in dates:
+            day_source = by_day.get(date_str, empty)
+            rows = stored[date_str]
+            if day_source.empty and not rows:
+                continue
+            missing = day_source
+            if rows and not day_source.empty:
+                merged = day_source.merge(key_frame(rows).drop_duplicates(), on=ROW_KEY, how='left', indicator=True)
+                missing = day_source[(merged['_merge'] == 'left_only').to_numpy()]
+            plans.append({
+                'group_id': group_id,
+                'date': date_str,
+                'stored': rows,
+                'missing': [log_row(bot, row) for _, row in missing.iterrows()],
+                'source': len(day_source),
+            })
+    return plans
+
+
+def repair_store(bot, plan):
+    """Add a day's missing rows to the group's activity log (or the database)."""
+    if bot.sqlite_storage is not None:
+        bot.persistence_writer.call(bot.sqlite_storage.insert_activities, plan['missing'], plan['date'])
+        return
+    excel_filename = bot.get_group_excel_filename(plan['group_id'], plan['date'])
+    log_filename = bot.get_group_log_filename(plan['group_id'], plan['date'])
+    # A day from before the activity log existed keeps its workbook rows
+    bot.persistence_writer.call(bot.seed_activity_log_from_excel, plan['group_id'], excel_filename, log_filename)
+    bot.persistence_writer.append(
+        log_filename, ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in plan['missing'])
+    )
+
+
+def count_detail_rows(filename):
+    """Number of data rows in a workbook's detail sheet."""
+    from openpyxl import load_workbook
+    workbook = load_workbook(filename, read_only=True)
+    try:
+        return sum(1 for _ in workbook['Chi tiết'].iter_rows(min_row=2, values_only=True))
+    finally:
+        workbook.close()
+
+
+def rebuild_day(group_id, date_str, rows, filename):
+    """Write one day's workbook and compute its rollup; runs in a worker process."""
+    import bot
+    filename = bot.write_group_excel(rows, filename)
+    rollup = bot.compute_rollup(bot.report_frame(rows))
+    return {
+        'group_id': group_id,
+        'date': date_str,
+        'filename': filename,
+        'workbook_rows': count_detail_rows(filename) if filename else 0,
+        'rollup_rows': sum(row[3] for row in rollup['rows']),
+        'rollup': rollup,
+    }
+
+
+def backfill(bot, args, start_date, end_date):
+    """Rebuild the range and return one result dict per (group, day)."""
+    start_str, end_str = start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d")
+    dates = []
+    day = start_date
+    while day <= end_date:
+        dates.append(day.strftime("%Y%m%d"))
+        day += timedelta(days=1)
+
+    entries = source_activities(bot, start_date - timedelta(days=1), end_date + timedelta(days=1))
+    source, unattributed = source_frame(bot, entries, start_str, end_str)
+    groups = set(int(group_id) for group_id in source['ID Nhóm'].unique()) | set(bot.group_settings)
+    if args.group:
+        groups &= set(args.group)
+    plans = plan_days(bot, source, sorted(groups), dates)
+
+    if not args.dry_run:
+        for plan in plans:
+            if plan['missing']:
+                repair_store(bot, plan)
+        # Workbooks must be newer than the logs they are built from
+        bot.persistence_writer.flush()
+
+    results = {}
+    for plan in plans:
+        results[(plan['group_id'], plan['date'])] = {
+            'group_id': plan['group_id'], 'date': plan['date'], 'source': plan['source'],
+            'stored': len(plan['stored']), 'added': len(plan['missing']),
+            'expected': len(plan['stored']) + len(plan['missing']),
+            'workbook_rows': None, 'rollup_rows': None,
+        }
+    if args.dry_run:
+        return list(results.values()), unattributed
+
+    os.makedirs(bot.REPORTS_DIR, exist_ok=True)
+    today_str = bot.clock.today_str()
+    # Workers import bot.py, which loads no state on import; spawn works on every platform
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as pool:
+        futures = []
+        for plan in plans:
+            # Rows are sent to the workers as tuples in EXCEL_COLUMNS order
+            rows = [tuple(row.get(column) for column in bot.EXCEL_COLUMNS) for row in plan['stored'] + plan['missing']]
+            filename = bot.get_group_excel_filename(plan['group_id'], plan['date'])
+            futures.append(pool.submit(rebuild_day, plan['group_id'], plan['date'], rows, filename))
+        for future in concurrent.futures.as_completed(futures):
+            built = future.result()
+            result = results[(built['group_id'], built['date'])]
+            result['workbook_rows'] = built['workbook_rows']
+            result['rollup_rows'] = built['rollup_rows']
+            # Only closed days keep a stored rollup
+            if built['date'] < today_str:
+                bot.save_daily_rollup(built['group_id'], built['date'], built['rollup'])
+    bot.persistence_writer.flush()
+    return list(results.values()), unattributed
+
+
+def is_ok(result):
+    if result['workbook_rows'] is None:
+        return True
+    return (result['workbook_rows'] == result['expected'] == result['rollup_rows']
+            and result['expected'] >= result['source'])
+
+
+def print_table(results, dry_run):
+    """Print one line per (group, day)."""
+    header = f"{'group':>16} {'date':>9} {'source':>7} {'stored':>7} {'added':>6} {'workbook':>9} {'rollup':>7}  status"
+    print(header)
+    print('-' * len(header))
+    for r in sorted(results, key=lambda r: (r['group_id'], r['date'])):
+        if dry_run:
+            status = 'MISSING' if r['added'] else 'ok'
+        else:
+            status = 'OK' if is_ok(r) else 'MISMATCH'
+        workbook = '-' if r['workbook_rows'] is None else r['workbook_rows']
+        rollup = '-' if r['rollup_rows'] is None else r['rollup_rows']
+        print(f"{r['group_id']:>16} {r['date']:>9} {r['source']:>7} {r['stored']:>7} {r['added']:>6} "
+              f"{workbook:>9} {rollup:>7}  {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from', dest='start', required=True, help='first day (dd/mm/yyyy or yyyy-mm-dd)')
+    parser.add_argument('--to', dest='end', help='last day, the first day by default')
+    parser.add_argument('--group', type=int, action='append', help='only this group ID (repeatable)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--dry-run', action='store_true', help='only report the rows missing from the logs')
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON')
+    args = parser.parse_args()
+
+    sys.path.insert(0, BOT_DIR)
+    import bot
+    bot.load_state()
+
+    today = bot.clock.local_now().date()
+    start_date = bot.parse_report_date(args.start, today)
+    end_date = bot.parse_report_date(args.end, today) if args.end else start_date
+    if start_date is None or end_date is None or start_date > end_date:
+        parser.error('invalid date range')
+
+    started = time.perf_counter()
+    results, unattributed = backfill(bot, args, start_date, end_date)
+    elapsed = time.perf_counter() - started
+    bot.persistence_writer.stop()
+
+    if args.json:
+        print(json.dumps({'results': results, 'unattributed': unattributed, 'seconds': elapsed}, indent=2))
+    else:
+        print_table(results, args.dry_run)
+        print(
+            f"\n{len(results)} group-day(s), {sum(r['added'] for r in results)} row(s) "
+            f"{'missing' if args.dry_run else 'added'}, {unattributed} activity(ies) without a group, "
+            f"{elapsed:.1f}s"
+        )
+    sys.exit(0 if all(is_ok(r) for r in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""Load test and latency benchmark for the activity handlers.
+
+Drives the real handle_activity_button / record_activity / journal path of
+bot.py with synthetic Update and Context objects and a stub bot, and reports
+handler latency percentiles, bytes written per button press and peak memory.
+
+Each scenario runs in its own subprocess, in a scratch directory, so state
+files, module globals and peak memory do not leak between scenarios. Peak
+memory is the peak RSS where the resource module exists (Unix); elsewhere it
+is the peak of Python allocations traced by tracemalloc, which also slows the
+handlers down.
+
+    python benchmark.py --users 50,200,500 --groups 1,5 --history 0,30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StubMessage:
+    """Incoming message whose replies are recorded instead of sent."""
+
+    def __init__(self, bot, chat_id, text):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+    async def reply_document(self, document, **kwargs):
+        return await self.bot.send_document(chat_id=self.chat_id, document=document, **kwargs)
+
+
+class StubBot:
+    """Bot replacement that counts outbound calls."""
+
+    def __init__(self):
+        self.message_id = 0
+        self.sent = 0
+        self.documents = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.message_id += 1
+        self.sent += 1
+        return SimpleNamespace(chat_id=chat_id, message_id=self.message_id)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.sent += 1
+        self.documents += 1
+        return SimpleNamespace(chat_id=chat_id, message_id=0)
+
+
+def make_update(bot, user_id, full_name, chat_id, text):
+    """Build the parts of a telegram Update that the handlers read."""
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, full_name=full_name),
+        effective_chat=SimpleNamespace(id=chat_id, type='supergroup', title=f'Group {chat_id}'),
+        message=StubMessage(bot, chat_id, text)
+    )
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def timed(func, samples):
+    """Wrap a synchronous function so each call's duration is appended to samples."""
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    return wrapper
+
+
+def directory_size(path):
+    """Total size in bytes of the files below path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def peak_memory_kb():
+    """Peak memory of this process in KiB: peak RSS, or the tracemalloc peak without resource."""
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1] / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kibibytes
+    return peak / 1024 if sys.platform == 'darwin' else peak
+
+
+def run_scenario(users, groups, history, activities, seed):
+    """Run one scenario in the current process and return its measurements."""
+    if resource is None:
+        tracemalloc.start()
+    sys.path.insert(0, BOT_DIR)
+    import bot
+    bot.load_state()
+
+    rng = random.Random(seed)
+    actions = list(bot.TIME_LIMITS)
+    stub = StubBot()
+    context = SimpleNamespace(bot=stub, args=[])
+    members = [(1000 + i, f'User {i}', -100 - (i % groups)) for i in range(users)]
+
+    # Completed activities from earlier days, as if the bot had been running a while
+    yesterday = datetime.now() - timedelta(days=1)
+    for user_id, full_name, chat_id in members:
+        state = bot.user_states.setdefault(user_id, {
+            'start_time': None, 'activities': [], 'action': None, 'status': 'inactive',
+            'chat_id': None, 'message_id': None
+        })
+        for _ in range(history):
+            action = rng.choice(actions)
+            duration = rng.uniform(1, bot.TIME_LIMITS[action] + 3)
+            start_time = yesterday - timedelta(minutes=rng.uniform(0, 600))
+            state['activities'].append(bot.ActivityRecord.create(
+                group_id=chat_id, username=full_name, full_name=full_name,
+                start_time=start_time, end_time=start_time + timedelta(minutes=duration),
+                duration=duration, action=action,
+                status='violation' if duration > bot.TIME_LIMITS[action] else 'completed',
+                violation_duration=max(0, duration - bot.TIME_LIMITS[action])
+            ))
+    bot.rebuild_daily_stats()
+
+    record_samples = []
+    journal_samples = []
+    bot.record_activity = timed(bot.record_activity, record_samples)
+    bot.journal_user_state = timed(bot.journal_user_state, journal_samples)
+
+    written = {'bytes': 0}
+    write_appends = bot.persistence_writer._write_appends
+    write_replace = bot.persistence_writer._write_replace
+
+    def count_appends(appends):
+        written['bytes'] += sum(len(chunk.encode('utf-8')) for chunks in appends.values() for chunk in chunks)
+        write_appends(appends)
+
+    def count_replace(path, text, truncate):
+        written['bytes'] += len(text if isinstance(text, bytes) else text.encode('utf-8'))
+        write_replace(path, text, truncate)
+
+    bot.persistence_writer._write_appends = count_appends
+    bot.persistence_writer._write_replace = count_replace
+
+    start_samples = []
+    checkout_samples = []
+
+    async def press(user_id, full_name, chat_id, text, samples):
+        update = make_update(stub, user_id, full_name, chat_id, text)
+        started = time.perf_counter()
+        await bot.handle_activity_button(update, context)
+        samples.append(time.perf_counter() - started)
+
+    async def drive():
+        await bot.persistence_writer.drain()
+        size_before = directory_size('.')
+        bytes_before = written['bytes']
+        started = time.perf_counter()
+        for _ in range(activities):
+            order = members[:]
+            rng.shuffle(order)
+            for user_id, full_name, chat_id in order:
+                action = rng.choice(actions)
+                await press(user_id, full_name, chat_id, action, start_samples)
+                # Pretend the activity lasted a while so some of them are violations
+                bot.user_states[user_id]['start_time'] -= timedelta(
+                    minutes=rng.uniform(1, bot.TIME_LIMITS[action] + 3)
+                )
+                await press(user_id, full_name, chat_id, '🔙 Quay về', checkout_samples)
+        elapsed = time.perf_counter() - started
+        await bot.persistence_writer.drain()
+        if bot.sqlite_storage is not None:
+            press_bytes = directory_size('.') - size_before
+        else:
+            press_bytes = written['bytes'] - bytes_before
+
+        compact_samples = []
+        for _ in range(3):
+            compact_started = time.perf_counter()
+            bot.compact_user_states()
+            compact_samples.append(time.perf_counter() - compact_started)
+        await bot.persistence_writer.drain()
+
+        presses = len(start_samples) + len(checkout_samples)
+        return elapsed, presses, press_bytes, compact_samples
+
+    elapsed, presses, press_bytes, compact_samples = asyncio.run(drive())
+    bot.persistence_writer.stop()
+
+    def summary(samples):
+        return {
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+        }
+
+    return {
+        'users': users,
+        'groups': groups,
+        'history': history,
+        'presses': presses,
+        'presses_per_second': presses / elapsed if elapsed else 0.0,
+        'start': summary(start_samples),
+        'checkout': summary(checkout_samples),
+        'record_activity': summary(record_samples),
+        'journal_user_state': summary(journal_samples),
+        'compact_user_states_ms': percentile(compact_samples, 0.5) * 1000,
+        'bytes_per_press': press_bytes / presses if presses else 0.0,
+        'peak_memory_kb': peak_memory_kb(),
+        'peak_memory_source': 'tracemalloc' if resource is None else 'rss',
+        'outbound_calls': stub.sent,
+    }
+
+
+def spawn_scenario(users, groups, history, activities, seed, backend):
+    """Run one scenario in a fresh interpreter inside a scratch directory."""
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        env = dict(os.environ)
+        env['STORAGE_BACKEND'] = backend
+        env['REPORTS_DIR'] = os.path.join(workdir, 'reports')
+        env['SQLITE_DB_FILE'] = os.path.join(workdir, 'bot.db')
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--scenario',
+             str(users), str(groups), str(history), str(activities), str(seed)],
+            cwd=workdir, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Scenario {users}/{groups}/{history} failed:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def print_table(results):
+    """Print one line per scenario."""
+    header = (
+        f"{'users':>6} {'groups':>6} {'hist':>5} {'presses':>8} {'press/s':>9} "
+        f"{'start p50/p95/p99 ms':>22} {'checkout p50/p95/p99 ms':>25} "
+        f"{'record p99':>10} {'compact':>8} {'B/press':>8} {'peak MB':>8}"
+    )
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        start = r['start']
+        checkout = r['checkout']
+        print(
+            f"{r['users']:>6} {r['groups']:>6} {r['history']:>5} {r['presses']:>8} "
+            f"{r['presses_per_second']:>9.0f} "
+            f"{start['p50_ms']:>6.2f}/{start['p95_ms']:>6.2f}/{start['p99_ms']:>6.2f}     "
+            f"{checkout['p50_ms']:>6.2f}/{checkout['p95_ms']:>6.2f}/{checkout['p99_ms']:>6.2f}        "
+            f"{r['record_activity']['p99_ms']:>10.3f} {r['compact_user_states_ms']:>8.1f} "
+            f"{r['bytes_per_press']:>8.0f} {r['peak_memory_kb'] / 1024:>8.1f}"
+        )
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=parse_list, default=[50, 200, 500], help='comma-separated user counts')
+    parser.add_argument('--groups', type=parse_list, default=[1, 5], help='comma-separated group counts')
+    parser.add_argument('--history', type=parse_list, default=[0, 30],
+                        help='comma-separated numbers of past activities per user')
+    parser.add_argument('--activities', type=int, default=30, help='activities per user in the measured run')
+    parser.add_argument('--backend', choices=('files', 'sqlite'), default='files')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON')
+    parser.add_argument('--scenario', nargs=5, type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(*args.scenario)))
+        return
+
+    results = []
+    for users in args.users:
+        for groups in args.groups:
+            for history in args.history:
+                results.append(spawn_scenario(users, groups, history, args.activities, args.seed, args.backend))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
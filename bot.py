@@ -1,7 +1,8 @@
 import os
 import logging
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta, time, timezone
 import pandas as pd
+import xlsxwriter
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ChatMemberHandler
 from dotenv import load_dotenv
@@ -10,6 +11,26 @@ from telegram.ext import JobQueue
 import telegram.error
 import pytz
 import json
+import functools
+import queue
+import threading
+import atexit
+import heapq
+import itertools
+import sqlite3
+import re
+import contextlib
+from time import perf_counter as timer_clock
+import pickle
+import collections
+import collections.abc
+import sys
+import hmac
+import signal
+import concurrent.futures
+import multiprocessing
+import hashlib
+import tempfile
 
 # Load environment variables
 load_dotenv()
@@ -30,12 +51,135 @@ TIME_LIMITS = {
     '🍽️ Cất Bát': 5,
 }
 
-# Store user states
+# Time zone that dates the activity logs and reports
+REPORT_TIMEZONE = pytz.timezone('Asia/Bangkok')
+
+# Reports directory (activity logs and generated Excel files)
+REPORTS_DIR = os.getenv('REPORTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports'))
+
+# Columns of the daily Excel report, in order
+EXCEL_COLUMNS = [
+    'ID Nhóm',
+    'ID',
+    'Tên',
+    'Hành động',
+    'Thời gian bắt đầu',
+    'Thời gian kết thúc',
+    'Tổng thời gian (phút)',
+    'Thời gian cho phép (phút)',
+    'Vi phạm',
+    'Thời gian vi phạm (phút)',
+]
+
+# User state snapshot (compact binary), the JSON snapshot it replaced, and the
+# journal of changes made since the snapshot was written
+USER_STATES_SNAPSHOT_FILE = 'user_states.bin'
+USER_STATES_FILE = 'user_states.json'
+USER_STATES_JOURNAL_FILE = 'user_states.journal'
+SNAPSHOT_VERSION = 1
+# How often the journal is folded into the snapshot (seconds)
+JOURNAL_COMPACT_INTERVAL = 300
+
+# Day-partitioned archive of activities older than the current day
+ARCHIVE_DIR = 'archive'
+# Number of archived days kept parsed in memory
+ARCHIVE_CACHE_DAYS = 31
+
+# Storage backend: 'files' (JSON/JSONL files) or 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'files')
+SQLITE_DB_FILE = os.getenv('SQLITE_DB_FILE', 'bot.db')
+
+# Local HTTP metrics endpoint (Prometheus text format); disabled when the port is empty
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT', '')
+# How updates are received: 'polling' or 'webhook'. In webhook mode Telegram
+# posts updates to WEBHOOK_URL, which must reach WEBHOOK_HOST:WEBHOOK_PORT at
+# WEBHOOK_PATH; requests must carry WEBHOOK_SECRET. Without WEBHOOK_URL the
+# webhook is not registered with Telegram (e.g. when it is managed elsewhere).
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = os.getenv('WEBHOOK_PORT', '8443')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Histogram bucket bounds (seconds)
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Background file writer: max operations handled per batch, and queue depth
+# above which handlers wait for the writer to catch up
+WRITER_BATCH_SIZE = 500
+WRITER_HIGH_WATER = 1000
+
+# Nightly report dispatch: uploads in flight at once and attempts per group
+REPORT_SEND_CONCURRENCY = 5
+REPORT_SEND_ATTEMPTS = 3
+# Workbooks are rendered in this many worker processes (0 renders in the bot
+# process); a render that takes longer than RENDER_TIMEOUT seconds is redone locally
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(min(2, os.cpu_count() or 1))))
+RENDER_TIMEOUT = 120
+# Updates processed at once; updates of one user (or admin commands of one
+# group) still run one at a time
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
+# Range reports: per-group daily rollups (one row per user and action) and
+# the longest range /report accepts, in days
+ROLLUPS_DIR = os.path.join(REPORTS_DIR, 'rollups')
+ROLLUP_COLUMNS = ['ID', 'Tên', 'Hành động', 'Số lần', 'Tổng thời gian (phút)', 'Số lần vi phạm', 'Thời gian vi phạm (phút)']
+ROLLUP_VERSION = 1
+MAX_REPORT_RANGE_DAYS = 366
+# Countdown warnings are sent this many seconds before the deadline
+COUNTDOWN_WARNINGS = (60, 20)
+# Outbound countdown alerts: per-chat token bucket (messages per second, burst),
+# window in which warnings of the same kind are merged, and send attempts
+CHAT_SEND_RATE = 20 / 60
+CHAT_SEND_BURST = 5
+WARNING_COALESCE_WINDOW = 2.0
+SEND_MAX_ATTEMPTS = 5
+# Lower values are sent first
+WARNING_PRIORITY = {0: 0, 20: 1, 60: 2}
+# Display names of group members: seconds a cached name stays valid, most
+# names kept, and getChatMember lookups /listadmin runs at once
+MEMBER_NAME_TTL = 6 * 3600
+MEMBER_NAME_CACHE_SIZE = 10000
+MEMBER_LOOKUP_CONCURRENCY = 5
+# Telegram file_ids of uploaded report files kept for re-sending without an upload
+REPORT_FILE_ID_CACHE_SIZE = 1000
+# Pinned live board of active users (groups that turn it on with /liveboard):
+# seconds between edits and most users listed
+LIVE_BOARD_INTERVAL = 5
+LIVE_BOARD_MAX_LINES = 50
+
+# State of users with nothing running and no activity for this many days is
+# dropped after midnight (0 keeps everyone)
+USER_IDLE_DAYS = int(os.getenv('USER_IDLE_DAYS', '30'))
+
+# Snapshot encoding: times are microseconds since the epoch, statuses and
+# actions are small integer codes
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+DAY_MICROSECONDS = 86_400_000_000
+ACTIVITY_STATUSES = ['completed', 'violation']
+ENCODED_ACTIVITY_FIELDS = (
+    'start_us', 'start_offset', 'end_us', 'end_offset', 'duration', 'action',
+    'status', 'violation_duration', 'group_id', 'username', 'full_name'
+)
+
+# Store user states (filled by load_state)
 user_states = {}
-# Store group settings
+# Store group settings (filled by load_state)
 group_settings = {}
-# Store countdown tasks
-countdown_tasks = {}
+# Action labels by code; codes stay stable for the life of the process
+action_names = list(TIME_LIMITS)
+action_codes = {name: code for code, name in enumerate(action_names)}
+# Activity logs already checked for a legacy workbook to import
+checked_activity_logs = set()
+# Per-(user_id, date) totals of completed activities, keyed by the activity's start date;
+# action_minutes holds the minutes spent on each action
+daily_stats = {}
+EMPTY_DAILY_STATS = {'total_duration': 0, 'activity_count': 0, 'violation_count': 0, 'action_minutes': {}}
+
+# Texts of the activity keyboard buttons; other chat messages never reach the handler
+ACTIVITY_BUTTON_LABELS = tuple(TIME_LIMITS) + ('🔙 Quay về',)
 
 activity_keyboard = ReplyKeyboardMarkup(
     [
@@ -60,18 +204,856 @@ activity_keyboard = ReplyKeyboardMarkup(
     is_persistent=True
 )
 
-def get_group_excel_filename(group_id):
+class Clock:
+    """Source of time for the bot.
+
+    Every time and date follows REPORT_TIMEZONE, whatever the server's
+    timezone: now() is its naive wall time, used for activities and
+    countdowns, and today_str() the report date. Replaced by a
+    VirtualClock in simulations.
+    """
+
+    def now(self):
+        """Current wall time in REPORT_TIMEZONE, without tzinfo."""
+        return self.local_now().replace(tzinfo=None)
+
+    def local_now(self):
+        return datetime.now(REPORT_TIMEZONE)
+
+    def today_str(self):
+        """Current report date as YYYYMMDD."""
+        return self.local_now().strftime("%Y%m%d")
+
+    def monotonic(self):
+        """Seconds from an arbitrary origin, for measuring intervals."""
+        return timer_clock()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds; returns a handle with cancel()."""
+        return asyncio.get_running_loop().call_later(delay, callback, *args)
+
+    async def wait_event(self, event, timeout):
+        """Wait until event is set or timeout seconds have passed (None waits forever)."""
+        # Not wait_for: it can swallow a cancellation that arrives as the event is set
+        waiter = asyncio.ensure_future(event.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            waiter.cancel()
+
+class VirtualClock(Clock):
+    """Clock whose time only moves when advanced; sleepers wake in time order.
+
+    The naive time is taken to be in REPORT_TIMEZONE. Simulations call
+    advance_to() between events instead of waiting in real time.
+    """
+
+    # Event loop passes given to woken tasks after each wakeup
+    SETTLE_ROUNDS = 20
+
+    def __init__(self, start):
+        self.start = start
+        self.current = start
+        self.sleepers = []
+        self.counter = itertools.count()
+
+    def local_now(self):
+        return REPORT_TIMEZONE.localize(self.current)
+
+    def monotonic(self):
+        return (self.current - self.start).total_seconds()
+
+    async def sleep(self, seconds):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.sleepers, (self.current + timedelta(seconds=seconds), next(self.counter), future))
+        await future
+
+    def call_later(self, delay, callback, *args):
+        async def run():
+            await self.sleep(delay)
+            callback(*args)
+        return asyncio.get_running_loop().create_task(run())
+
+    async def wait_event(self, event, timeout):
+        if timeout is None:
+            await event.wait()
+            return
+        waiter = asyncio.ensure_future(event.wait())
+        sleeper = asyncio.ensure_future(self.sleep(timeout))
+        try:
+            await asyncio.wait({waiter, sleeper}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            sleeper.cancel()
+
+    async def settle(self):
+        """Let tasks that are ready run until they block again."""
+        for _ in range(self.SETTLE_ROUNDS):
+            await asyncio.sleep(0)
+
+    async def advance_to(self, target):
+        """Move time forward to target, waking sleepers in time order."""
+        await self.settle()
+        while self.sleepers and self.sleepers[0][0] <= target:
+            due, _, future = heapq.heappop(self.sleepers)
+            if future.done():
+                continue
+            self.current = max(self.current, due)
+            future.set_result(None)
+            await self.settle()
+        self.current = max(self.current, target)
+        await self.settle()
+
+    async def advance(self, seconds):
+        await self.advance_to(self.current + timedelta(seconds=seconds))
+
+clock = Clock()
+
+class Metrics:
+    """In-process counters, gauges and histograms, rendered in Prometheus text format."""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name, kind, text):
+        """Set the type and help text of a metric."""
+        self.help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record one value in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0, 'max': 0.0
+                }
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+
+    def gauge(self, name, func, text):
+        """Register a gauge whose value is read from func() at scrape time."""
+        self.describe(name, 'gauge', text)
+        self.gauges[name] = func
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of a with-block in a histogram."""
+        started = timer_clock()
+        try:
+            yield
+        finally:
+            self.observe(name, timer_clock() - started, **labels)
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            help_kind, text = self.help.get(name, (kind, name))
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {help_kind}')
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(h, buckets=list(h['buckets']))) for key, h in self.histograms.items())
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                lines.append(f'{name}_bucket{label_text(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{label_text(labels, [("le", "+Inf")])} {histogram["count"]}')
+            lines.append(f'{name}_sum{label_text(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{label_text(labels)} {histogram["count"]}')
+        for name, func in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            try:
+                lines.append(f'{name} {func()}')
+            except Exception as e:
+                logging.error(f"Error reading gauge {name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return a short human-readable summary for the /metrics command."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(h)) for key, h in self.histograms.items())
+        lines = []
+        for (name, labels), histogram in histograms:
+            label = ', '.join(f'{v}' for _, v in labels)
+            average = histogram['sum'] / histogram['count'] * 1000 if histogram['count'] else 0
+            lines.append(
+                f"• {name}{f' ({label})' if label else ''}: {histogram['count']} lần, "
+                f"TB {average:.1f} ms, max {histogram['max'] * 1000:.1f} ms"
+            )
+        for (name, labels), value in counters:
+            label = ', '.join(f'{v}' for _, v in labels)
+            lines.append(f"• {name}{f' ({label})' if label else ''}: {value:g}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                lines.append(f"• {name}: {func()}")
+            except Exception:
+                continue
+        return '\n'.join(lines)
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'histogram', 'Handler latency per command')
+metrics.describe('bot_handler_errors_total', 'counter', 'Handler exceptions per command')
+metrics.describe('bot_write_seconds', 'histogram', 'Duration of file writes by the persistence writer')
+metrics.describe('bot_write_bytes_total', 'counter', 'Bytes written by the persistence writer')
+metrics.describe('bot_excel_build_seconds', 'histogram', 'Duration of Excel report builds')
+metrics.describe('bot_excel_bytes_total', 'counter', 'Bytes of Excel reports built')
+metrics.describe('bot_outbound_sent_total', 'counter', 'Countdown alerts sent')
+metrics.describe('bot_outbound_retries_total', 'counter', 'Countdown alert send retries')
+metrics.describe('bot_outbound_failures_total', 'counter', 'Countdown alerts that could not be sent')
+metrics.describe('bot_daily_report_seconds', 'histogram', 'Duration of the daily report job')
+metrics.describe('bot_daily_reports_total', 'counter', 'Daily reports by result')
+metrics.describe('bot_webhook_requests_total', 'counter', 'Webhook requests by result')
+metrics.describe('bot_excel_renders_total', 'counter', 'Excel reports rendered, by where they were rendered')
+metrics.describe('bot_excel_render_fallbacks_total', 'counter', 'Worker renders redone in the bot process, by reason')
+metrics.describe('bot_member_name_lookups_total', 'counter', 'Member display names needed by /listadmin, by cache result')
+metrics.describe('bot_live_board_edits_total', 'counter', 'Live board messages sent or edited, by result')
+metrics.describe('bot_activity_rejections_total', 'counter', 'Activity starts refused by a group limit, by reason')
+metrics.describe('bot_report_uploads_total', 'counter', 'Report files sent, by whether they were uploaded or re-sent by file_id')
+metrics.describe('bot_lock_waits_total', 'counter', 'Updates that waited for another update of the same user or group')
+
+def instrumented(name):
+    """Decorator recording latency and errors of an async handler under a command name."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = timer_clock()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                metrics.inc('bot_handler_errors_total', command=name)
+                raise
+            finally:
+                metrics.observe('bot_handler_seconds', timer_clock() - started, command=name)
+        return wrapper
+    return decorator
+
+class KeyedLocks:
+    """asyncio locks created on demand per key, dropped once no task holds or waits for them."""
+
+    def __init__(self, name):
+        self.name = name
+        self.locks = {}
+
+    def __len__(self):
+        return len(self.locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        """Hold the lock of a key for the duration of an async with-block."""
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        if entry[0].locked():
+            metrics.inc('bot_lock_waits_total', scope=self.name)
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+# Button presses are serialized per user, settings changes per group
+user_locks = KeyedLocks('user')
+group_locks = KeyedLocks('group')
+metrics.gauge('bot_locked_users', lambda: len(user_locks), 'Users with an update being processed')
+
+def serialized(scope):
+    """Decorator running an async handler under the lock of its update's user or group."""
+    locks = user_locks if scope == 'user' else group_locks
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            key = update.effective_user.id if scope == 'user' else update.effective_chat.id
+            async with locks.hold(key):
+                return await handler(update, context)
+        return wrapper
+    return decorator
+
+class LocalHTTPServer:
+    """Minimal asyncio HTTP/1.1 server for local endpoints (one request per connection).
+
+    Routes map (method, path) to an async function taking a request dict with
+    'method', 'path', 'headers' and 'body' and returning (status, content_type, body).
+    """
+
+    REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 408: 'Request Timeout', 413: 'Payload Too Large',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+    MAX_BODY = 1024 * 1024
+    MAX_HEADERS = 100
+    # Seconds a client has to send the whole request
+    READ_TIMEOUT = 10
+    # Connections served at once; further ones are closed straight away
+    MAX_CONNECTIONS = 100
+
+    def __init__(self, host, port, routes):
+        self.host = host
+        self.port = port
+        self.routes = routes
+        self.server = None
+        self.connections = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        if self.connections >= self.MAX_CONNECTIONS:
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            await self._respond(reader, writer)
+        finally:
+            self.connections -= 1
+
+    async def _respond(self, reader, writer):
+        try:
+            status, content_type, body = await self._dispatch(reader)
+        except Exception as e:
+            logging.error(f"Error handling HTTP request: {e}")
+            status, content_type, body = 500, 'text/plain', 'error\n'
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        writer.write(
+            f'HTTP/1.1 {status} {self.REASONS.get(status, "")}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, reader):
+        try:
+            request = await asyncio.wait_for(self._read_request(reader), self.READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            return 408, 'text/plain', 'request timeout\n'
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            return 400, 'text/plain', 'bad request\n'
+        if isinstance(request, tuple):
+            return request
+        method, path = request['method'], request['path']
+        handler = self.routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for _, route_path in self.routes):
+                return 405, 'text/plain', 'method not allowed\n'
+            return 404, 'text/plain', 'not found\n'
+        return await handler(request)
+
+    async def _read_request(self, reader):
+        """Read one request; returns the request dict, or a (status, content_type, body) error."""
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            return 400, 'text/plain', 'bad request\n'
+        method, path = request_line[0].upper(), request_line[1].split('?', 1)[0]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            if len(headers) >= self.MAX_HEADERS:
+                return 400, 'text/plain', 'too many headers\n'
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        length = headers.get('content-length') or '0'
+        if not length.isdigit():
+            return 400, 'text/plain', 'bad content length\n'
+        length = int(length)
+        if length > self.MAX_BODY:
+            return 413, 'text/plain', 'too large\n'
+        body = await reader.readexactly(length) if length else b''
+        return {'method': method, 'path': path, 'headers': headers, 'body': body}
+
+async def metrics_endpoint(request):
+    """Serve the Prometheus metrics."""
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render()
+
+def webhook_routes(application):
+    """Routes of the webhook server: the update endpoint plus health and readiness checks."""
+
+    async def receive_update(request):
+        token = request['headers'].get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+            metrics.inc('bot_webhook_requests_total', result='forbidden')
+            return 403, 'text/plain', 'forbidden\n'
+        if not application.running:
+            # Telegram retries the delivery later
+            metrics.inc('bot_webhook_requests_total', result='not_ready')
+            return 503, 'text/plain', 'not ready\n'
+        try:
+            update = Update.de_json(json.loads(request['body']), application.bot)
+        except Exception as e:
+            logging.error(f"Invalid update posted to webhook: {e}")
+            metrics.inc('bot_webhook_requests_total', result='invalid')
+            return 400, 'text/plain', 'invalid update\n'
+        await application.update_queue.put(update)
+        metrics.inc('bot_webhook_requests_total', result='accepted')
+        return 200, 'text/plain', 'ok\n'
+
+    async def healthz(request):
+        return 200, 'text/plain', 'ok\n'
+
+    async def readyz(request):
+        if application.running and persistence_writer.thread is not None and persistence_writer.thread.is_alive():
+            return 200, 'text/plain', 'ready\n'
+        return 503, 'text/plain', 'not ready\n'
+
+    return {
+        ('POST', WEBHOOK_PATH): receive_update,
+        ('GET', '/healthz'): healthz,
+        ('GET', '/readyz'): readyz
+    }
+
+async def run_webhook(application):
+    """Receive updates through the webhook server until SIGINT/SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
+    
+    server = LocalHTTPServer(WEBHOOK_HOST, int(WEBHOOK_PORT), webhook_routes(application))
+    await server.start()
+    try:
+        await application.initialize()
+        await post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+        await application.start()
+        logging.info("Receiving updates through the webhook")
+        await stop_event.wait()
+    finally:
+        # Stop accepting updates before the application shuts down
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+class PersistenceWriter:
+    """Background thread that performs the file writes queued by the handlers.
+
+    Handlers only enqueue operations. The thread drains the queue in batches,
+    writes all queued appends to the same file with a single open/write and
+    collapses repeated full rewrites of a file to the last one.
+    """
+
+    def __init__(self, batch_size=WRITER_BATCH_SIZE, high_water=WRITER_HIGH_WATER):
+        self.batch_size = batch_size
+        self.high_water = high_water
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the writer thread if it is not running."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='persistence-writer', daemon=True)
+                self.thread.start()
+
+    def qsize(self):
+        """Number of operations waiting to be written."""
+        return self.queue.qsize()
+
+    def append(self, path, text):
+        """Queue text to be appended to a file."""
+        self._submit(('append', path, text))
+
+    def replace(self, path, text, truncate=()):
+        """Queue an atomic rewrite of a file (text or bytes), then truncation of the given files."""
+        self._submit(('replace', path, text, tuple(truncate)))
+
+    def call(self, func, *args):
+        """Queue a function to run on the writer thread, after all earlier operations."""
+        self._submit(('call', func, args))
+
+    def _submit(self, op):
+        self.start()
+        self.queue.put(op)
+
+    async def wait_for_capacity(self):
+        """Wait while the writer is behind by more than the high-water mark."""
+        while self.queue.qsize() > self.high_water:
+            await asyncio.sleep(0.05)
+
+    async def drain(self):
+        """Wait until every operation queued so far has been written."""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.call(lambda: loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None)))
+        await done
+
+    def flush(self):
+        """Block until the queue is empty."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self):
+        """Write everything still queued and stop the thread."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                self._write_batch([op for op in batch if op is not None])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        last_replace = {}
+        for index, op in enumerate(batch):
+            if op[0] == 'replace':
+                if op[1] in last_replace:
+                    # A later rewrite supersedes this one, but keep its truncations
+                    earlier = batch[last_replace[op[1]]]
+                    op = batch[index] = op[:3] + (tuple(set(earlier[3]) | set(op[3])),)
+                last_replace[op[1]] = index
+
+        appends = {}
+        for index, op in enumerate(batch):
+            if op[0] == 'append':
+                appends.setdefault(op[1], []).append(op[2])
+                continue
+            self._write_appends(appends)
+            appends = {}
+            if op[0] == 'replace':
+                if last_replace[op[1]] == index:
+                    self._write_replace(*op[1:])
+            elif op[0] == 'call':
+                try:
+                    with metrics.timer('bot_write_seconds', kind='call'):
+                        op[1](*op[2])
+                except Exception as e:
+                    logging.error(f"Error in persistence writer call {op[1]}: {e}")
+        self._write_appends(appends)
+
+    def _write_appends(self, appends):
+        for path, chunks in appends.items():
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                data = ''.join(chunks).encode('utf-8')
+                with metrics.timer('bot_write_seconds', kind='append'):
+                    with open(path, 'ab') as f:
+                        f.write(data)
+                metrics.inc('bot_write_bytes_total', len(data), kind='append')
+            except Exception as e:
+                logging.error(f"Error appending to {path}: {e}")
+
+    def _write_replace(self, path, text, truncate):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_filename = f'{path}.temp'
+            data = text if isinstance(text, bytes) else text.encode('utf-8')
+            with metrics.timer('bot_write_seconds', kind='replace'):
+                with open(temp_filename, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_filename, path)
+            metrics.inc('bot_write_bytes_total', len(data), kind='replace')
+        except Exception as e:
+            logging.error(f"Error writing {path}: {e}")
+            return
+        for truncate_path in truncate:
+            try:
+                open(truncate_path, 'w', encoding='utf-8').close()
+            except Exception as e:
+                logging.error(f"Error truncating {truncate_path}: {e}")
+
+persistence_writer = PersistenceWriter()
+atexit.register(persistence_writer.stop)
+metrics.gauge('bot_writer_queue_depth', persistence_writer.qsize, 'Operations waiting for the persistence writer')
+
+class SQLiteStorage:
+    """SQLite (WAL mode) storage for activities, user states and group settings.
+
+    Writes are made on the persistence writer thread; reads may come from any
+    thread, each of which gets its own connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY,
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT,
+            action TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            duration REAL NOT NULL,
+            time_limit REAL,
+            violation TEXT NOT NULL,
+            violation_duration REAL NOT NULL,
+            date TEXT NOT NULL,
+            recorded_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_activities_group_date ON activities (group_id, date);
+        CREATE INDEX IF NOT EXISTS idx_activities_user_date ON activities (user_id, date);
+        CREATE INDEX IF NOT EXISTS idx_activities_action ON activities (action);
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            start_time TEXT,
+            action TEXT,
+            status TEXT NOT NULL,
+            chat_id INTEGER,
+            message_id INTEGER,
+            full_name TEXT,
+            last_active TEXT
+        );
+        CREATE TABLE IF NOT EXISTS group_settings (
+            group_id INTEGER PRIMARY KEY,
+            settings TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            group_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            rollup TEXT NOT NULL,
+            PRIMARY KEY (group_id, date)
+        );
+    """
+
+    # Activity table columns and the report (EXCEL_COLUMNS) names they hold
+    ROW_COLUMNS = {
+        'group_id': 'ID Nhóm',
+        'user_id': 'ID',
+        'user_name': 'Tên',
+        'action': 'Hành động',
+        'start_time': 'Thời gian bắt đầu',
+        'end_time': 'Thời gian kết thúc',
+        'duration': 'Tổng thời gian (phút)',
+        'time_limit': 'Thời gian cho phép (phút)',
+        'violation': 'Vi phạm',
+        'violation_duration': 'Thời gian vi phạm (phút)',
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(self.SCHEMA)
+            # Databases created before idle eviction have no last_active column
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(user_states)')}
+            if 'last_active' not in columns:
+                conn.execute('ALTER TABLE user_states ADD COLUMN last_active TEXT')
+
+    def connection(self):
+        """Return this thread's connection."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def is_empty(self):
+        """Whether nothing has been stored yet."""
+        conn = self.connection()
+        for table in ('activities', 'user_states', 'group_settings'):
+            if conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+                return False
+        return True
+
+    def insert_activities(self, rows, date_str):
+        """Insert report rows (keyed by EXCEL_COLUMNS names) for a day."""
+        columns = list(self.ROW_COLUMNS)
+        # Wall-clock time: compared with workbook modification times
+        recorded_at = datetime.now().timestamp()
+        with self.connection() as conn:
+            conn.executemany(
+                f"INSERT INTO activities ({', '.join(columns)}, date, recorded_at) "
+                f"VALUES ({', '.join('?' * (len(columns) + 2))})",
+                [[row.get(self.ROW_COLUMNS[c]) for c in columns] + [date_str, recorded_at] for row in rows]
+            )
+
+    def upsert_user_states(self, records):
+        """Insert or update the current state of users."""
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT INTO user_states (user_id, start_time, action, status, chat_id, message_id, full_name, last_active) "
+                "VALUES (:user_id, :start_time, :action, :status, :chat_id, :message_id, :full_name, :last_active) "
+                "ON CONFLICT (user_id) DO UPDATE SET start_time = excluded.start_time, "
+                "action = excluded.action, status = excluded.status, chat_id = excluded.chat_id, "
+                "message_id = excluded.message_id, full_name = COALESCE(excluded.full_name, full_name), "
+                "last_active = COALESCE(excluded.last_active, last_active)",
+                records
+            )
+
+    def delete_user_states(self, user_ids):
+        """Delete the current state of users."""
+        with self.connection() as conn:
+            conn.executemany('DELETE FROM user_states WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+
+    def replace_group_settings(self, settings):
+        """Replace all group settings; `settings` maps group ID to its JSON text."""
+        with self.connection() as conn:
+            conn.execute('DELETE FROM group_settings')
+            conn.executemany(
+                'INSERT INTO group_settings (group_id, settings) VALUES (?, ?)',
+                settings.items()
+            )
+
+    def save_rollup(self, group_id, date_str, text):
+        """Store a group's daily rollup (JSON text)."""
+        with self.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO daily_rollups (group_id, date, rollup) VALUES (?, ?, ?)',
+                (group_id, date_str, text)
+            )
+
+    def load_rollup(self, group_id, date_str):
+        """Return a group's stored daily rollup (JSON text), or None."""
+        row = self.connection().execute(
+            'SELECT rollup FROM daily_rollups WHERE group_id = ? AND date = ?', (group_id, date_str)
+        ).fetchone()
+        return row['rollup'] if row else None
+
+    def load_group_settings(self):
+        """Return group settings keyed by group ID."""
+        rows = self.connection().execute('SELECT group_id, settings FROM group_settings')
+        return {row['group_id']: json.loads(row['settings']) for row in rows}
+
+    def load_user_states(self, current_date):
+        """Return user states in their JSON form, with activities from current_date on."""
+        conn = self.connection()
+        states = {}
+        for row in conn.execute('SELECT * FROM user_states'):
+            state = dict(row)
+            states[str(state.pop('user_id'))] = dict(state, activities=[])
+        for row in conn.execute('SELECT * FROM activities WHERE date >= ? ORDER BY id', (current_date,)):
+            state = states.setdefault(
+                str(row['user_id']),
+                {'start_time': None, 'activities': [], 'action': None, 'status': 'inactive'}
+            )
+            state['activities'].append(self._activity_from_row(row))
+        return states
+
+    def query_group_activities(self, group_id, date_from, date_to=None):
+        """Return a group's report rows (keyed by EXCEL_COLUMNS names) for a day or date range."""
+        rows = self.connection().execute(
+            'SELECT * FROM activities WHERE group_id = ? AND date BETWEEN ? AND ? ORDER BY id',
+            (group_id, date_from, date_to or date_from)
+        )
+        return [{name: row[column] for column, name in self.ROW_COLUMNS.items()} for row in rows]
+
+    def query_daily_activities(self, date_str):
+        """Return (user_id, activity) pairs of every activity of a day."""
+        rows = self.connection().execute('SELECT * FROM activities WHERE date = ? ORDER BY id', (date_str,))
+        return [(row['user_id'], self._activity_from_row(row)) for row in rows]
+
+    def last_recorded_at(self, group_id, date_str):
+        """Return when the group's latest activity of a day was stored (epoch seconds), or None."""
+        row = self.connection().execute(
+            'SELECT MAX(recorded_at) FROM activities WHERE group_id = ? AND date = ?',
+            (group_id, date_str)
+        ).fetchone()
+        return row[0]
+
+    def _activity_from_row(self, row):
+        return {
+            'date': row['end_time'][:10].replace('-', ''),
+            'group_id': row['group_id'],
+            'username': row['user_name'],
+            'full_name': row['user_name'],
+            'start_time': row['start_time'],
+            'end_time': row['end_time'],
+            'duration': row['duration'],
+            'status': 'violation' if row['violation'] == 'Có' else 'completed',
+            'action': row['action'],
+            'violation_duration': row['violation_duration']
+        }
+
+# Opened by load_state() when STORAGE_BACKEND is 'sqlite'
+sqlite_storage = None
+
+def get_group_excel_filename(group_id, date_str=None):
     """Generate Excel filename for a specific group."""
-    reports_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports')
-    os.makedirs(reports_dir, exist_ok=True)
+    os.makedirs(REPORTS_DIR, exist_ok=True)
     
-    utc_plus_7 = pytz.timezone('Asia/Bangkok')
-    now = datetime.now(utc_plus_7)
-    filename = f'activities_group_{group_id}_{now.strftime("%Y%m%d")}.xlsx'
-    full_path = os.path.join(reports_dir, filename)
+    if date_str is None:
+        date_str = clock.today_str()
+    filename = f'activities_group_{group_id}_{date_str}.xlsx'
+    full_path = os.path.join(REPORTS_DIR, filename)
     
     return full_path
 
+def get_group_log_filename(group_id, date_str=None):
+    """Generate append-only activity log filename for a specific group."""
+    return os.path.splitext(get_group_excel_filename(group_id, date_str))[0] + '.jsonl'
+
 def is_superadmin(user_id, chat_id):
     """Check if user is superadmin in the group or là ID trong .env."""
     initial_superadmin_id = int(os.getenv('INITIAL_SUPERADMIN_ID', '0'))
@@ -88,15 +1070,23 @@ def is_admin(user_id, chat_id):
     return user_id in group_settings[chat_id]['admin_ids']
 
 def save_group_settings():
-    """Save group settings to JSON file."""
-    with open('group_settings.json', 'w', encoding='utf-8') as f:
-        settings_to_save = {}
-        for group_id, settings in group_settings.items():
-            settings_to_save[str(group_id)] = settings
-        json.dump(settings_to_save, f, ensure_ascii=False, indent=4)
+    """Queue a write of group settings to JSON file (or the database)."""
+    if sqlite_storage is not None:
+        settings_to_save = {
+            group_id: json.dumps(settings, ensure_ascii=False)
+            for group_id, settings in group_settings.items()
+        }
+        persistence_writer.call(sqlite_storage.replace_group_settings, settings_to_save)
+        return
+    settings_to_save = {}
+    for group_id, settings in group_settings.items():
+        settings_to_save[str(group_id)] = settings
+    persistence_writer.replace('group_settings.json', json.dumps(settings_to_save, ensure_ascii=False, indent=4))
 
 def load_group_settings():
-    """Load group settings from JSON file."""
+    """Load group settings from JSON file (or the database)."""
+    if sqlite_storage is not None:
+        return sqlite_storage.load_group_settings()
     try:
         with open('group_settings.json', 'r', encoding='utf-8') as f:
             settings = json.load(f)
@@ -104,75 +1094,716 @@ def load_group_settings():
     except FileNotFoundError:
         return {}
 
-def save_user_states():
-    """Save user states to JSON file."""
+def serialize_activity(activity):
+    """Return a JSON-serializable copy of an activity record."""
+    activity = dict(activity)
+    if 'start_time' in activity and isinstance(activity['start_time'], datetime):
+        activity['start_time'] = activity['start_time'].isoformat()
+    if 'end_time' in activity and isinstance(activity['end_time'], datetime):
+        activity['end_time'] = activity['end_time'].isoformat()
+    if 'duration' in activity:
+        if isinstance(activity['duration'], str):
+            try:
+                activity['duration'] = float(activity['duration'])
+            except ValueError:
+                activity['duration'] = 0.0
+    return activity
+
+def parse_activity(activity):
+    """Convert a stored activity record back to its in-memory form (in place)."""
+    if 'start_time' in activity and isinstance(activity['start_time'], str):
+        activity['start_time'] = datetime.fromisoformat(activity['start_time'])
+    if 'end_time' in activity and isinstance(activity['end_time'], str):
+        activity['end_time'] = datetime.fromisoformat(activity['end_time'])
+    if 'duration' in activity:
+        if isinstance(activity['duration'], str):
+            try:
+                activity['duration'] = float(activity['duration'])
+            except ValueError:
+                activity['duration'] = 0.0
+    return activity
+
+def encode_time(value):
+    """Encode a datetime as (microseconds since the epoch, UTC offset in seconds or None)."""
+    if value is None:
+        return None, None
+    if value.tzinfo is None:
+        return (value - EPOCH) // MICROSECOND, None
+    return (value - EPOCH_UTC) // MICROSECOND, int(value.utcoffset().total_seconds())
+
+def decode_time(us, offset):
+    """Inverse of encode_time."""
+    if us is None:
+        return None
+    if offset is None:
+        return EPOCH + timedelta(microseconds=us)
+    return (EPOCH_UTC + timedelta(microseconds=us)).astimezone(timezone(timedelta(seconds=offset)))
+
+def to_report_time(value):
+    """Return a datetime as naive wall time in REPORT_TIMEZONE, as clock.now() gives; naive values are returned as is."""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(REPORT_TIMEZONE).replace(tzinfo=None)
+    return value
+
+@functools.lru_cache(maxsize=4096)
+def epoch_day_to_date(day):
+    """Format a day number (days since 1970-01-01) as YYYYMMDD."""
+    return (EPOCH + timedelta(days=day)).strftime("%Y%m%d")
+
+def get_action_code(action):
+    """Return the small integer code of an action label, assigning one if needed."""
+    if action is None:
+        return None
+    code = action_codes.get(action)
+    if code is None:
+        code = action_codes[action] = len(action_names)
+        action_names.append(action)
+    return code
+
+class ActivityRecord(collections.abc.Mapping):
+    """Completed activity, stored in slots but read like the old dict record.
+
+    Actions and statuses are kept as small integer codes and names are
+    interned, so records of the same user share one name string.
+    """
+
+    __slots__ = (
+        'start_time', 'end_time', 'duration', 'action_code', 'status_code',
+        'violation_duration', 'group_id', 'username', 'full_name'
+    )
+    KEYS = (
+        'date', 'group_id', 'username', 'full_name', 'start_time', 'end_time',
+        'duration', 'status', 'action', 'violation_duration'
+    )
+    OPTIONAL_KEYS = {'group_id': 'group_id', 'action': 'action_code', 'violation_duration': 'violation_duration'}
+
+    def __init__(self, start_time, end_time, duration, action_code, status_code,
+                 violation_duration=None, group_id=None, username=None, full_name=None):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.duration = duration
+        self.action_code = action_code
+        self.status_code = status_code
+        self.violation_duration = violation_duration
+        self.group_id = group_id
+        self.username = sys.intern(username) if isinstance(username, str) else username
+        self.full_name = sys.intern(full_name) if isinstance(full_name, str) else full_name
+
+    @classmethod
+    def create(cls, start_time, end_time, duration, status, action=None, violation_duration=None,
+               group_id=None, username=None, full_name=None, date=None):
+        """Build a record from the fields of the dict form ('date' is derived from end_time)."""
+        if isinstance(duration, str):
+            try:
+                duration = float(duration)
+            except ValueError:
+                duration = 0.0
+        return cls(
+            start_time, end_time, duration, get_action_code(action),
+            ACTIVITY_STATUSES.index(status) if status in ACTIVITY_STATUSES else status,
+            violation_duration, group_id, username, full_name
+        )
+
+    @classmethod
+    def from_mapping(cls, activity):
+        """Convert a parsed dict record (see parse_activity)."""
+        if isinstance(activity, cls):
+            return activity
+        return cls.create(
+            activity['start_time'], activity.get('end_time'), activity.get('duration', 0.0),
+            activity.get('status'), activity.get('action'), activity.get('violation_duration'),
+            activity.get('group_id'), activity.get('username'), activity.get('full_name')
+        )
+
+    def __getitem__(self, key):
+        if key == 'date':
+            return self.end_time.strftime("%Y%m%d") if self.end_time is not None else None
+        if key == 'status':
+            status = self.status_code
+            return ACTIVITY_STATUSES[status] if isinstance(status, int) else status
+        if key in self.OPTIONAL_KEYS:
+            value = getattr(self, self.OPTIONAL_KEYS[key])
+            if value is None:
+                raise KeyError(key)
+            return action_names[value] if key == 'action' else value
+        if key in ('username', 'full_name', 'start_time', 'end_time', 'duration'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.KEYS:
+            if key not in self.OPTIONAL_KEYS or getattr(self, self.OPTIONAL_KEYS[key]) is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'ActivityRecord({dict(self)!r})'
+
+def encode_activity(activity):
+    """Encode an activity record as a compact tuple (see ENCODED_ACTIVITY_FIELDS)."""
+    if isinstance(activity, ActivityRecord):
+        start_us, start_offset = encode_time(activity.start_time)
+        end_us, end_offset = encode_time(activity.end_time)
+        return (
+            start_us, start_offset, end_us, end_offset, activity.duration, activity.action_code,
+            activity.status_code, activity.violation_duration, activity.group_id,
+            activity.username, activity.full_name
+        )
+    start_us, start_offset = encode_time(activity['start_time'])
+    end_us, end_offset = encode_time(activity.get('end_time'))
+    status = activity.get('status')
+    duration = activity.get('duration', 0.0)
+    if isinstance(duration, str):
+        try:
+            duration = float(duration)
+        except ValueError:
+            duration = 0.0
+    return (
+        start_us, start_offset, end_us, end_offset, duration,
+        get_action_code(activity.get('action')),
+        ACTIVITY_STATUSES.index(status) if status in ACTIVITY_STATUSES else status,
+        activity.get('violation_duration'),
+        activity.get('group_id'),
+        activity.get('username'),
+        activity.get('full_name')
+    )
+
+def decode_activity(encoded):
+    """Inverse of encode_activity."""
+    (start_us, start_offset, end_us, end_offset, duration, action,
+     status, violation_duration, group_id, username, full_name) = encoded
+    return ActivityRecord(
+        decode_time(start_us, start_offset), decode_time(end_us, end_offset), duration,
+        action, status, violation_duration, group_id, username, full_name
+    )
+
+def encoded_activity_date(encoded):
+    """Return the YYYYMMDD start date of an encoded activity without decoding it."""
+    start_us, start_offset = encoded[0], encoded[1]
+    return epoch_day_to_date((start_us + (start_offset or 0) * 1_000_000) // DAY_MICROSECONDS)
+
+class LazyActivities(collections.UserList):
+    """Activity list that keeps snapshot (encoded) records until it is first read."""
+
+    def __init__(self, initlist=None, encoded=None):
+        self._data = None
+        self.encoded = None
+        if encoded is not None:
+            self.encoded = encoded
+        else:
+            self._data = list(initlist) if initlist is not None else []
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = [decode_activity(item) for item in self.encoded]
+            self.encoded = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.encoded = None
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.encoded) if self._data is None else len(self._data)
+
+    def encode(self):
+        """Return the encoded records, reusing them if the list was never read."""
+        if self._data is None:
+            return self.encoded
+        return [encode_activity(activity) for activity in self._data]
+
+    def iter_totals(self):
+        """Yield (start date, duration, status, action) of each record without decoding it."""
+        if self._data is not None:
+            for activity in self._data:
+                yield get_activity_date(activity), activity['duration'], activity['status'], activity.get('action')
+            return
+        for item in self.encoded:
+            status, action = item[6], item[5]
+            yield (
+                encoded_activity_date(item), item[4],
+                ACTIVITY_STATUSES[status] if isinstance(status, int) else status,
+                action_names[action] if isinstance(action, int) else action
+            )
+
+    def pop_before(self, date_str):
+        """Remove and return (decoded) the records that started before date_str."""
+        if self._data is not None:
+            old = [a for a in self._data if (get_activity_date(a) or date_str) < date_str]
+            if old:
+                self._data = [a for a in self._data if not ((get_activity_date(a) or date_str) < date_str)]
+            return old
+        old = [item for item in self.encoded if encoded_activity_date(item) < date_str]
+        if old:
+            self.encoded = [item for item in self.encoded if encoded_activity_date(item) >= date_str]
+        return [decode_activity(item) for item in old]
+
+def encode_user_states(states):
+    """Serialize user states to the compact binary snapshot format."""
+    users = {}
+    for user_id, state in states.items():
+        start_us, start_offset = encode_time(state['start_time'])
+        activities = state['activities']
+        if isinstance(activities, LazyActivities):
+            encoded = activities.encode()
+        else:
+            encoded = [encode_activity(activity) for activity in activities]
+        users[user_id] = (
+            start_us, start_offset, state['action'], state['status'],
+            state.get('chat_id'), state.get('message_id'), state.get('full_name'),
+            encoded
+        )
+    last_active = {user_id: state['last_active'] for user_id, state in states.items() if 'last_active' in state}
+    snapshot = {'version': SNAPSHOT_VERSION, 'actions': list(action_names), 'users': users, 'last_active': last_active}
+    return pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+
+def decode_user_states(data):
+    """Load user states from the compact binary snapshot format."""
+    snapshot = pickle.loads(data)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported user state snapshot version {snapshot.get('version')}")
+    remap = [get_action_code(name) for name in snapshot['actions']]
+    identity = remap == list(range(len(remap)))
+    
+    # Snapshots written before idle eviction have no last_active dates
+    last_active = snapshot.get('last_active', {})
+    states = {}
+    for user_id, (start_us, start_offset, action, status, chat_id, message_id, full_name, encoded) in snapshot['users'].items():
+        if not identity:
+            encoded = [
+                item[:5] + ((remap[item[5]] if item[5] is not None else None),) + item[6:]
+                for item in encoded
+            ]
+        states[user_id] = {
+            'start_time': to_report_time(decode_time(start_us, start_offset)),
+            'activities': LazyActivities(encoded=encoded),
+            'action': action,
+            'status': status,
+            'chat_id': chat_id,
+            'message_id': message_id
+        }
+        if full_name is not None:
+            states[user_id]['full_name'] = full_name
+        if user_id in last_active:
+            states[user_id]['last_active'] = last_active[user_id]
+    return states
+
+def save_user_states(truncate=()):
+    """Queue a full snapshot of user states to the snapshot file (or the database)."""
     try:
-        with open('user_states.json', 'w', encoding='utf-8') as f:
-            states_to_save = {}
-            for user_id, state in user_states.items():
-                states_to_save[str(user_id)] = state.copy()
-                if 'start_time' in state and isinstance(state['start_time'], datetime):
-                    states_to_save[str(user_id)]['start_time'] = state['start_time'].isoformat()
-                if 'activities' in state:
-                    for activity in states_to_save[str(user_id)]['activities']:
-                        if 'start_time' in activity and isinstance(activity['start_time'], datetime):
-                            activity['start_time'] = activity['start_time'].isoformat()
-                        if 'end_time' in activity and isinstance(activity['end_time'], datetime):
-                            activity['end_time'] = activity['end_time'].isoformat()
-                        if 'duration' in activity:
-                            if isinstance(activity['duration'], str):
-                                try:
-                                    activity['duration'] = float(activity['duration'])
-                                except ValueError:
-                                    activity['duration'] = 0.0
-            json.dump(states_to_save, f, ensure_ascii=False, indent=4)
+        if sqlite_storage is not None:
+            records = [user_state_record(user_id) for user_id in user_states]
+            persistence_writer.call(sqlite_storage.upsert_user_states, records)
+            return True
+        persistence_writer.replace(USER_STATES_SNAPSHOT_FILE, encode_user_states(user_states), truncate=truncate)
+        return True
     except Exception as e:
         logging.error(f"Error saving user states: {e}")
+        return False
 
-def load_user_states():
-    """Load user states from JSON file."""
+def user_state_record(user_id):
+    """Return the JSON-serializable current state (without history) of a user."""
+    state = user_states[user_id]
+    return {
+        'user_id': user_id,
+        'start_time': state['start_time'].isoformat() if isinstance(state['start_time'], datetime) else state['start_time'],
+        'action': state['action'],
+        'status': state['status'],
+        'chat_id': state.get('chat_id'),
+        'message_id': state.get('message_id'),
+        'full_name': state.get('full_name'),
+        'last_active': state.get('last_active')
+    }
+
+def journal_user_state(user_id, activity=None):
+    """Append one user's state change (and the activity it completed, if any) to the journal.
+
+    With the SQLite backend the user's row is updated instead; the activity
+    itself is stored by record_activity.
+    """
+    record = user_state_record(user_id)
+    if sqlite_storage is not None:
+        persistence_writer.call(sqlite_storage.upsert_user_states, [record])
+        return
+    if activity is not None:
+        record['activity'] = serialize_activity(activity)
+    persistence_writer.append(USER_STATES_JOURNAL_FILE, json.dumps(record, ensure_ascii=False) + '\n')
+
+def compact_user_states():
+    """Fold the journal into a fresh snapshot and start a new journal."""
+    if sqlite_storage is not None:
+        return
+    save_user_states(truncate=(USER_STATES_JOURNAL_FILE,))
+
+async def compact_user_states_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job to periodically compact the user state journal."""
+    compact_user_states()
+
+def replay_user_state_journal(states):
+    """Apply journal records on top of loaded user states."""
     try:
-        with open('user_states.json', 'r', encoding='utf-8') as f:
-            states = json.load(f)
-            loaded_states = {}
-            for k, v in states.items():
-                loaded_states[int(k)] = {
-                    'start_time': None,
-                    'activities': [],
-                    'action': None,
-                    'status': 'inactive'
-                }
-                
-                if 'start_time' in v and isinstance(v['start_time'], str):
-                    loaded_states[int(k)]['start_time'] = datetime.fromisoformat(v['start_time'])
-                if 'activities' in v:
-                    loaded_states[int(k)]['activities'] = v['activities']
-                    for activity in loaded_states[int(k)]['activities']:
-                        if 'start_time' in activity and isinstance(activity['start_time'], str):
-                            activity['start_time'] = datetime.fromisoformat(activity['start_time'])
-                        if 'end_time' in activity and isinstance(activity['end_time'], str):
-                            activity['end_time'] = datetime.fromisoformat(activity['end_time'])
-                        if 'duration' in activity:
-                            if isinstance(activity['duration'], str):
-                                try:
-                                    activity['duration'] = float(activity['duration'])
-                                except ValueError:
-                                    activity['duration'] = 0.0
-                if 'action' in v:
-                    loaded_states[int(k)]['action'] = v['action']
-                if 'status' in v:
-                    loaded_states[int(k)]['status'] = v['status']
-            return loaded_states
+        f = open(USER_STATES_JOURNAL_FILE, 'r', encoding='utf-8')
     except FileNotFoundError:
-        return {}
+        return
+    seen_activities = {}
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.error("Skipping damaged line in user state journal")
+                continue
+            user_id = int(record['user_id'])
+            if record.get('evicted'):
+                states.pop(user_id, None)
+                seen_activities.pop(user_id, None)
+                continue
+            state = states.setdefault(user_id, parse_user_state({}))
+            state['start_time'] = to_report_time(datetime.fromisoformat(record['start_time'])) if record.get('start_time') else None
+            state['action'] = record.get('action')
+            state['status'] = record.get('status', 'inactive')
+            state['chat_id'] = record.get('chat_id')
+            state['message_id'] = record.get('message_id')
+            if record.get('full_name'):
+                state['full_name'] = record['full_name']
+            if record.get('last_active'):
+                state['last_active'] = record['last_active']
+            activity = record.get('activity')
+            if activity is None:
+                continue
+            activity = ActivityRecord.from_mapping(parse_activity(activity))
+            # A crash between writing the snapshot and truncating the journal leaves
+            # records that are already in the snapshot; skip those.
+            if user_id not in seen_activities:
+                seen_activities[user_id] = {a['start_time'] for a in state['activities']}
+            if activity['start_time'] in seen_activities[user_id]:
+                continue
+            seen_activities[user_id].add(activity['start_time'])
+            state['activities'].append(activity)
+
+def parse_user_state(v):
+    """Convert a user state in its JSON form to its in-memory form."""
+    state = {
+        'start_time': None,
+        'activities': [],
+        'action': None,
+        'status': 'inactive',
+        'chat_id': None,
+        'message_id': None
+    }
+    
+    # Older states kept aware start times; running activities are timed against clock.now()
+    if 'start_time' in v and isinstance(v['start_time'], str):
+        state['start_time'] = to_report_time(datetime.fromisoformat(v['start_time']))
+    if 'activities' in v:
+        state['activities'] = [
+            ActivityRecord.from_mapping(parse_activity(activity)) for activity in v['activities']
+        ]
+    if 'action' in v:
+        state['action'] = v['action']
+    if 'status' in v:
+        state['status'] = v['status']
+    if 'chat_id' in v:
+        state['chat_id'] = v['chat_id']
+    if 'message_id' in v:
+        state['message_id'] = v['message_id']
+    if 'full_name' in v:
+        state['full_name'] = v['full_name']
+    if v.get('last_active'):
+        state['last_active'] = v['last_active']
+    return state
+
+def load_user_states_files():
+    """Load user states from the snapshot plus the journal.
+
+    Returns (states, from_json); from_json is True when the states came from
+    the old JSON snapshot, which has not been migrated yet.
+    """
+    if os.path.exists(USER_STATES_SNAPSHOT_FILE):
+        with open(USER_STATES_SNAPSHOT_FILE, 'rb') as f:
+            states = decode_user_states(f.read())
+        from_json = False
+    else:
+        try:
+            with open(USER_STATES_FILE, 'r', encoding='utf-8') as f:
+                states = {int(k): parse_user_state(v) for k, v in json.load(f).items()}
+            from_json = True
+        except FileNotFoundError:
+            states = {}
+            from_json = False
+    replay_user_state_journal(states)
+    return states, from_json
+
+def migrate_user_states_snapshot(states):
+    """Write the binary snapshot for states loaded from JSON and retire the JSON file."""
+    temp_filename = f'{USER_STATES_SNAPSHOT_FILE}.temp'
+    with open(temp_filename, 'wb') as f:
+        f.write(encode_user_states(states))
+    os.replace(temp_filename, USER_STATES_SNAPSHOT_FILE)
+    open(USER_STATES_JOURNAL_FILE, 'w', encoding='utf-8').close()
+    os.replace(USER_STATES_FILE, f'{USER_STATES_FILE}.migrated')
+    logging.info(f"Migrated {USER_STATES_FILE} to {USER_STATES_SNAPSHOT_FILE}")
+
+def load_user_states():
+    """Load user states from the snapshot plus the journal (or the database)."""
+    try:
+        if sqlite_storage is not None:
+            states = sqlite_storage.load_user_states(clock.today_str())
+            return {int(k): parse_user_state(v) for k, v in states.items()}
+        states, from_json = load_user_states_files()
+        if from_json:
+            migrate_user_states_snapshot(states)
+        return states
     except Exception as e:
         logging.error(f"Error loading user states: {e}")
         return {}
 
-# Load settings when bot starts
-group_settings = load_group_settings()
-user_states = load_user_states()
+def update_daily_stats(user_id, activity):
+    """Add a completed activity to the user's daily totals."""
+    activity_date = get_activity_date(activity)
+    if activity_date is None:
+        return
+    add_daily_stats(user_id, activity_date, activity['duration'], activity['status'], activity.get('action'))
+
+def add_daily_stats(user_id, activity_date, activity_duration, status, action=None):
+    """Add one activity's duration and status to a user's totals for a day."""
+    key = (user_id, activity_date)
+    if key not in daily_stats:
+        daily_stats[key] = dict(EMPTY_DAILY_STATS, action_minutes={})
+    stats = daily_stats[key]
+    
+    if status == 'violation':
+        stats['violation_count'] += 1
+    
+    if isinstance(activity_duration, str):
+        try:
+            activity_duration = float(activity_duration)
+        except ValueError:
+            return
+    stats['total_duration'] += activity_duration
+    stats['activity_count'] += 1
+    if action is not None:
+        stats['action_minutes'][action] = stats['action_minutes'].get(action, 0) + activity_duration
+
+def rebuild_daily_stats():
+    """Rebuild the daily totals index from all loaded user activities."""
+    daily_stats.clear()
+    for user_id, state in user_states.items():
+        activities = state['activities']
+        if isinstance(activities, LazyActivities):
+            for activity_date, activity_duration, status, action in activities.iter_totals():
+                if activity_date is not None:
+                    add_daily_stats(user_id, activity_date, activity_duration, status, action)
+            continue
+        for activity in activities:
+            update_daily_stats(user_id, activity)
+
+def get_archive_filename(date_str):
+    """Generate archive filename for one day of activities."""
+    return os.path.join(ARCHIVE_DIR, f'activities_{date_str}.jsonl')
+
+def get_activity_date(activity):
+    """Return the YYYYMMDD day an activity belongs to (its start date), or None."""
+    activity_start_time = activity['start_time']
+    if isinstance(activity_start_time, str):
+        try:
+            activity_start_time = datetime.fromisoformat(activity_start_time)
+        except ValueError:
+            return None
+    return activity_start_time.strftime("%Y%m%d")
+
+def archive_old_activities(current_date=None):
+    """Move activities older than the current day from user_states to the archive."""
+    if current_date is None:
+        current_date = clock.today_str()
+    
+    archived = {}
+    for user_id, state in user_states.items():
+        if isinstance(state['activities'], LazyActivities):
+            for activity in state['activities'].pop_before(current_date):
+                archived.setdefault(get_activity_date(activity), []).append((user_id, activity))
+            continue
+        kept = []
+        for activity in state['activities']:
+            activity_date = get_activity_date(activity)
+            if activity_date is not None and activity_date < current_date:
+                archived.setdefault(activity_date, []).append((user_id, activity))
+            else:
+                kept.append(activity)
+        if len(kept) != len(state['activities']):
+            state['activities'] = kept
+    
+    if not archived:
+        return 0
+    
+    if sqlite_storage is not None:
+        # The database already holds the history
+        for key in [key for key in daily_stats if key[1] < current_date]:
+            del daily_stats[key]
+        return sum(len(entries) for entries in archived.values())
+    
+    for activity_date, entries in archived.items():
+        lines = []
+        for user_id, activity in entries:
+            record = serialize_activity(activity)
+            record['user_id'] = user_id
+            lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+        persistence_writer.append(get_archive_filename(activity_date), ''.join(lines))
+    persistence_writer.call(load_archived_activities.cache_clear)
+    
+    for key in [key for key in daily_stats if key[1] < current_date]:
+        del daily_stats[key]
+    
+    compact_user_states()
+    count = sum(len(entries) for entries in archived.values())
+    logging.info(f"Archived {count} activities from {len(archived)} day(s)")
+    return count
+
+def evict_idle_users(idle_days=USER_IDLE_DAYS):
+    """Drop the state of users with nothing running and no activity for idle_days days.
+
+    Run after archiving, so user_states only holds the current day's history.
+    Users without a last activity date (saved before idle eviction existed)
+    count as active today, and that date is stored. Returns how many users
+    were dropped.
+    """
+    if not idle_days:
+        return 0
+    today_str = clock.today_str()
+    cutoff = (clock.local_now() - timedelta(days=idle_days)).strftime("%Y%m%d")
+    idle = []
+    undated = []
+    for user_id, state in user_states.items():
+        if state['status'] == 'active' or state['start_time'] is not None or len(state['activities']):
+            continue
+        if 'last_active' not in state:
+            state['last_active'] = today_str
+            undated.append(user_id)
+        if state['last_active'] < cutoff:
+            idle.append(user_id)
+    # The snapshot picks the dates up on its next compaction
+    if undated and sqlite_storage is not None:
+        persistence_writer.call(sqlite_storage.upsert_user_states, [user_state_record(user_id) for user_id in undated])
+    if not idle:
+        return 0
+    
+    for user_id in idle:
+        del user_states[user_id]
+    if sqlite_storage is not None:
+        persistence_writer.call(sqlite_storage.delete_user_states, idle)
+    else:
+        persistence_writer.append(
+            USER_STATES_JOURNAL_FILE,
+            ''.join(json.dumps({'user_id': user_id, 'evicted': True}) + '\n' for user_id in idle)
+        )
+    logging.info(f"Dropped the state of {len(idle)} user(s) idle for {idle_days} day(s)")
+    return len(idle)
+
+metrics.gauge('bot_user_states', lambda: len(user_states), 'Users whose state is kept in memory')
+
+async def archive_old_activities_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job to archive the previous day's activities after midnight, then drop idle users."""
+    try:
+        archive_old_activities()
+        evict_idle_users()
+    except Exception as e:
+        logging.error(f"Error in archive_old_activities_job: {e}")
+
+@functools.lru_cache(maxsize=ARCHIVE_CACHE_DAYS)
+def load_archived_activities(date_str):
+    """Load one archived day as a tuple of (user_id, activity) pairs (read by backfill.py)."""
+    if sqlite_storage is not None:
+        return tuple(
+            (user_id, parse_activity(activity))
+            for user_id, activity in sqlite_storage.query_daily_activities(date_str)
+        )
+    try:
+        f = open(get_archive_filename(date_str), 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return ()
+    entries = []
+    seen = set()
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.error(f"Skipping damaged line in archive {date_str}")
+                continue
+            user_id = record.pop('user_id')
+            # An interrupted archive run can append the same activity twice
+            if (user_id, record.get('start_time')) in seen:
+                continue
+            seen.add((user_id, record.get('start_time')))
+            entries.append((user_id, parse_activity(record)))
+    return tuple(entries)
 
+def migrate_files_to_sqlite():
+    """Import JSON, activity log and Excel data into an empty SQLite database."""
+    if sqlite_storage is None or not sqlite_storage.is_empty():
+        return
+    
+    try:
+        with open('group_settings.json', 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+        sqlite_storage.replace_group_settings({
+            int(k): json.dumps(v, ensure_ascii=False) for k, v in settings.items()
+        })
+    except FileNotFoundError:
+        pass
+    
+    # Only the current state is imported; history comes from the report files
+    records = []
+    for user_id, state in load_user_states_files()[0].items():
+        records.append({
+            'user_id': user_id,
+            'start_time': state['start_time'].isoformat() if state['start_time'] is not None else None,
+            'action': state['action'],
+            'status': state['status'],
+            'chat_id': state.get('chat_id'),
+            'message_id': state.get('message_id'),
+            'full_name': state.get('full_name'),
+            'last_active': state.get('last_active')
+        })
+    sqlite_storage.upsert_user_states(records)
+    
+    imported = 0
+    report_files = sorted(os.listdir(REPORTS_DIR)) if os.path.isdir(REPORTS_DIR) else []
+    for name in report_files:
+        match = re.fullmatch(r'activities_group_(-?\d+)_(\d{8})\.(jsonl|xlsx)', name)
+        if match is None:
+            continue
+        group_id, date_str, extension = int(match.group(1)), match.group(2), match.group(3)
+        path = os.path.join(REPORTS_DIR, name)
+        try:
+            if extension == 'jsonl':
+                rows = read_activity_log(path)
+            elif os.path.exists(get_group_log_filename(group_id, date_str)):
+                continue
+            else:
+                rows = read_excel_rows(group_id, path)
+        except Exception as e:
+            logging.error(f"Error importing {name}: {e}")
+            continue
+        sqlite_storage.insert_activities(rows, date_str)
+        imported += len(rows)
+    logging.info(f"Imported {len(records)} user(s) and {imported} activities into {sqlite_storage.path}")
+
+@instrumented('start')
+@serialized('group')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     if update.effective_chat.type == 'private':
@@ -214,6 +1845,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=activity_keyboard
     )
 
+@instrumented('addadmin')
+@serialized('group')
 async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add a new admin to the group."""
     if not is_superadmin(update.effective_user.id, update.effective_chat.id):
@@ -238,6 +1871,8 @@ async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text('❌ ID không hợp lệ. Vui lòng nhập số.')
 
+@instrumented('removeadmin')
+@serialized('group')
 async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Remove an admin from the group."""
     if not is_superadmin(update.effective_user.id, update.effective_chat.id):
@@ -266,6 +1901,7 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text('❌ ID không hợp lệ. Vui lòng nhập số.')
 
+@instrumented('listadmin')
 async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all admins in the group."""
     if not is_admin(update.effective_user.id, update.effective_chat.id):
@@ -275,88 +1911,61 @@ async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     group_id = update.effective_chat.id
     admin_list = group_settings[group_id]['admin_ids']
     superadmin_list = group_settings[group_id]['superadmin_ids']
+    member_names.put(group_id, update.effective_user.id, update.effective_user.full_name)
+    names = await member_names.resolve(context.bot, group_id, admin_list)
     
     admin_text = "👥 Danh sách admin:\n"
     for admin_id in admin_list:
-        try:
-            chat_member = await context.bot.get_chat_member(group_id, admin_id)
-            role = "👑 Superadmin" if admin_id in superadmin_list else "👤 Admin"
-            admin_text += f"- {chat_member.user.full_name} (ID: {admin_id}) - {role}\n"
-        except:
-            role = "👑 Superadmin" if admin_id in superadmin_list else "👤 Admin"
+        role = "👑 Superadmin" if admin_id in superadmin_list else "👤 Admin"
+        if names.get(admin_id):
+            admin_text += f"- {names[admin_id]} (ID: {admin_id}) - {role}\n"
+        else:
             admin_text += f"- ID: {admin_id} - {role}\n"
     
     await update.message.reply_text(admin_text)
 
+@instrumented('activity_button')
+@serialized('user')
 async def handle_activity_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle activity button press."""
     user_id = update.effective_user.id
-    
-    if user_id not in user_states:
-        user_states[user_id] = {
-            'start_time': None,
-            'activities': [],
-            'action': None,
-            'status': 'inactive'
-        }
+    member_names.put(update.effective_chat.id, user_id, update.effective_user.full_name)
     
     if update.message and update.message.text:
         current_action = update.message.text
         if current_action == "🔙 Quay về":
-            if user_states[user_id]['start_time'] is not None:
-                if user_id in countdown_tasks:
-                    countdown_tasks[user_id].cancel()
-                    del countdown_tasks[user_id]
+            if user_id in user_states and user_states[user_id]['start_time'] is not None:
+                countdown_scheduler.cancel(user_id)
+                live_board.remove(user_states[user_id]['chat_id'], user_id)
+                occupancy.remove(user_id)
 
                 start_time = user_states[user_id]['start_time']
-                end_time = datetime.now()
+                end_time = clock.now()
                 duration = (end_time - start_time).total_seconds() / 60
                 
                 is_violation = duration > TIME_LIMITS.get(user_states[user_id]['action'], float('inf'))
                 status = 'violation' if is_violation else 'completed'
                 
-                current_activity = {
-                    'date': end_time.strftime("%Y%m%d"),
-                    'username': update.effective_user.full_name,
-                    'full_name': update.effective_user.full_name,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'duration': duration,
-                    'status': status,
-                    'action': user_states[user_id].get('action', 'Unknown'),
-                    'violation_duration': duration - TIME_LIMITS.get(user_states[user_id]['action'], 0) if is_violation else 0
-                }
+                current_activity = ActivityRecord.create(
+                    group_id=update.effective_chat.id,
+                    username=update.effective_user.full_name,
+                    full_name=update.effective_user.full_name,
+                    start_time=start_time,
+                    end_time=end_time,
+                    duration=duration,
+                    status=status,
+                    action=user_states[user_id].get('action', 'Unknown'),
+                    violation_duration=duration - TIME_LIMITS.get(user_states[user_id]['action'], 0) if is_violation else 0
+                )
                 
                 user_states[user_id]['activities'].append(current_activity)
+                update_daily_stats(user_id, current_activity)
                 
                 current_date = end_time.strftime("%Y%m%d")
-                total_duration = 0
-                activity_count = 0
-                violation_count = 0
-                
-                today_activities = []
-                for activity in user_states[user_id]['activities']:
-                    activity_start_time = activity['start_time']
-                    if isinstance(activity_start_time, str):
-                        try:
-                            activity_start_time = datetime.fromisoformat(activity_start_time)
-                        except ValueError:
-                            continue
-                    
-                    if activity_start_time.strftime("%Y%m%d") == current_date:
-                        today_activities.append(activity)
-                        if activity['status'] == 'violation':
-                            violation_count += 1
-                
-                for activity in today_activities:
-                    activity_duration = activity['duration']
-                    if isinstance(activity_duration, str):
-                        try:
-                            activity_duration = float(activity_duration)
-                        except ValueError:
-                            continue
-                    total_duration += activity_duration
-                    activity_count += 1
+                today_stats = daily_stats.get((user_id, current_date), EMPTY_DAILY_STATS)
+                total_duration = today_stats['total_duration']
+                activity_count = today_stats['activity_count']
+                violation_count = today_stats['violation_count']
                 
                 success = record_activity(
                     update.effective_chat.id,
@@ -371,6 +1980,9 @@ async def handle_activity_button(update: Update, context: ContextTypes.DEFAULT_T
                 user_states[user_id]['start_time'] = None
                 user_states[user_id]['action'] = None
                 user_states[user_id]['status'] = 'inactive'
+                user_states[user_id]['chat_id'] = None
+                user_states[user_id]['message_id'] = None
+                user_states[user_id]['last_active'] = clock.today_str()
                 
                 duration_minutes = int(duration)
                 duration_seconds = int((duration - duration_minutes) * 60)
@@ -399,7 +2011,8 @@ async def handle_activity_button(update: Update, context: ContextTypes.DEFAULT_T
                     result_message += f"⚠️ Vượt quá thời gian cho phép ({TIME_LIMITS[current_activity['action']]} phút)"
                 
                 await update.message.reply_text(result_message, reply_markup=activity_keyboard)
-                save_user_states()
+                journal_user_state(user_id, current_activity)
+                await persistence_writer.wait_for_capacity()
             else:
                 await update.message.reply_text(
                     '❌ Bạn không có hoạt động nào đang diễn ra.',
@@ -408,7 +2021,7 @@ async def handle_activity_button(update: Update, context: ContextTypes.DEFAULT_T
             return
             
         if current_action in TIME_LIMITS:
-            if user_states[user_id]['start_time'] is not None:
+            if user_id in user_states and user_states[user_id]['start_time'] is not None:
                 await update.message.reply_text(
                     f'⚠️ Bạn đang trong hoạt động khác.\n'
                     'Vui lòng nhấn "🔙 Quay về" trước khi bắt đầu hoạt động mới.',
@@ -416,170 +2029,1395 @@ async def handle_activity_button(update: Update, context: ContextTypes.DEFAULT_T
                 )
                 return
             
-            current_time = datetime.now()
+            current_time = clock.now()
+            chat_id = update.effective_chat.id
+            rejection = check_activity_limits(chat_id, user_id, current_action, clock.today_str())
+            if rejection is not None:
+                await update.message.reply_text(rejection, reply_markup=activity_keyboard)
+                return
+            
+            # State is only created for users who actually start an activity
+            if user_id not in user_states:
+                user_states[user_id] = parse_user_state({})
             user_states[user_id]['start_time'] = current_time
             user_states[user_id]['action'] = current_action
             user_states[user_id]['status'] = 'active'
+            user_states[user_id]['last_active'] = clock.today_str()
+            occupancy.add(user_id, chat_id, current_action)
             
-            message = await update.message.reply_text(
-                f"Bạn đã bắt đầu hoạt động {current_action}.\n"
-                f"Thời gian bắt đầu: {current_time.strftime('%H:%M:%S')}\n"
-                f"Thời gian cho phép: {TIME_LIMITS[current_action]} phút",
-                reply_markup=activity_keyboard
+            message_id = None
+            if not live_board_enabled(chat_id):
+                message = await update.message.reply_text(
+                    f"Bạn đã bắt đầu hoạt động {current_action}.\n"
+                    f"Thời gian bắt đầu: {current_time.strftime('%H:%M:%S')}\n"
+                    f"Thời gian cho phép: {TIME_LIMITS[current_action]} phút",
+                    reply_markup=activity_keyboard
+                )
+                chat_id = message.chat_id
+                message_id = message.message_id
+            
+            user_states[user_id]['full_name'] = update.effective_user.full_name
+            user_states[user_id]['chat_id'] = chat_id
+            user_states[user_id]['message_id'] = message_id
+            countdown_scheduler.schedule(
+                user_id=user_id,
+                user_name=update.effective_user.full_name,
+                chat_id=chat_id,
+                message_id=message_id,
+                action=current_action,
+                start_time=current_time,
+                time_limit=TIME_LIMITS[current_action]
+            )
+            live_board.add(
+                chat_id, user_id, update.effective_user.full_name,
+                current_action, current_time, TIME_LIMITS[current_action]
             )
+            journal_user_state(user_id)
+            await persistence_writer.wait_for_capacity()
+
+@instrumented('liveboard')
+@serialized('group')
+async def liveboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Turn the group's pinned live board on or off (superadmin only)."""
+    group_id = update.effective_chat.id
+    if not is_superadmin(update.effective_user.id, group_id):
+        await update.message.reply_text('❌ Chỉ superadmin mới có thể sử dụng lệnh này.')
+        return
+    
+    mode = context.args[0].lower() if context.args else ''
+    if mode not in ('on', 'off'):
+        await update.message.reply_text('❌ Cú pháp: /liveboard on hoặc /liveboard off')
+        return
+    
+    settings = group_settings.get(group_id)
+    if settings is None:
+        await update.message.reply_text('❌ Nhóm chưa được cấu hình. Vui lòng dùng /start trước.')
+        return
+    if mode == 'on':
+        settings['live_board'] = True
+        save_group_settings()
+        await update.message.reply_text(
+            f'✅ Đã bật bảng trạng thái. Bảng được ghim và cập nhật mỗi {LIVE_BOARD_INTERVAL} giây; '
+            'bot không gửi tin nhắn khi bắt đầu hoạt động và không gửi cảnh báo đếm ngược.'
+        )
+        return
+    
+    settings['live_board'] = False
+    message_id = settings.pop('live_board_message_id', None)
+    live_board.texts.pop(group_id, None)
+    save_group_settings()
+    if message_id:
+        try:
+            await context.bot.unpin_chat_message(chat_id=group_id, message_id=message_id)
+        except telegram.error.TelegramError as e:
+            logging.warning(f"Cannot unpin live board in chat {group_id}: {e}")
+    await update.message.reply_text('✅ Đã tắt bảng trạng thái.')
+
+def format_group_limits(settings):
+    """Describe a group's occupancy limits and daily quotas."""
+    lines = ['📏 Giới hạn của nhóm:']
+    for key, limit in (settings.get('occupancy_limits') or {}).items():
+        lines.append(f"- Tối đa {limit} người {'ra ngoài cùng lúc' if key == '*' else key + ' cùng lúc'}")
+    for key, quota in (settings.get('daily_quotas') or {}).items():
+        lines.append(f"- Tối đa {quota} phút/người/ngày {'cho tất cả hoạt động' if key == '*' else 'cho ' + key}")
+    if len(lines) == 1:
+        lines.append('- Chưa có giới hạn nào.')
+    elif settings.get('daily_quotas'):
+        lines.append('Chỉ bắt đầu được hoạt động khi số phút còn lại đủ cho thời gian cho phép của hoạt động đó.')
+    return '\n'.join(lines)
+
+async def set_group_limit(update, context, setting, usage):
+    """Shared body of /setlimit and /setquota: `<hoạt động|all> <số>`, 0 removes the limit."""
+    group_id = update.effective_chat.id
+    if not is_superadmin(update.effective_user.id, group_id):
+        await update.message.reply_text('❌ Chỉ superadmin mới có thể sử dụng lệnh này.')
+        return
+    settings = group_settings.get(group_id)
+    if settings is None:
+        await update.message.reply_text('❌ Nhóm chưa được cấu hình. Vui lòng dùng /start trước.')
+        return
+    
+    if len(context.args) < 2:
+        await update.message.reply_text(usage)
+        return
+    try:
+        value = int(context.args[-1])
+    except ValueError:
+        value = -1
+    action = parse_limit_action(context.args[:-1])
+    if value < 0 or action is None:
+        await update.message.reply_text(usage)
+        return
+    
+    limits = settings.setdefault(setting, {})
+    if value:
+        limits[action] = value
+    else:
+        limits.pop(action, None)
+    save_group_settings()
+    await update.message.reply_text('✅ Đã cập nhật.\n' + format_group_limits(settings))
+
+@instrumented('setlimit')
+@serialized('group')
+async def set_limit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set how many people may be in an activity at once (superadmin only)."""
+    await set_group_limit(
+        update, context, 'occupancy_limits',
+        '❌ Cú pháp: /setlimit <hoạt động|all> <số người>\nVí dụ: /setlimit Hút Thuốc 3 (0 để bỏ giới hạn)'
+    )
+
+@instrumented('setquota')
+@serialized('group')
+async def set_quota_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set how many minutes per day each user may spend on an activity (superadmin only)."""
+    await set_group_limit(
+        update, context, 'daily_quotas',
+        '❌ Cú pháp: /setquota <hoạt động|all> <số phút>\nVí dụ: /setquota all 60 (0 để bỏ giới hạn)'
+    )
+
+@instrumented('limits')
+async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the group's occupancy limits and daily quotas."""
+    group_id = update.effective_chat.id
+    if not is_admin(update.effective_user.id, group_id):
+        await update.message.reply_text('❌ Chỉ admin mới có thể sử dụng lệnh này.')
+        return
+    await update.message.reply_text(format_group_limits(group_settings[group_id]))
+
+@instrumented('keyboard')
+async def keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send keyboard when /keyboard command is issued."""
+    if update.effective_chat.type == 'private':
+        await update.message.reply_text('❌ Bot này chỉ hoạt động trong nhóm.')
+        return
+
+    await update.message.reply_text(
+        '⌨️ Bàn phím hoạt động:',
+        reply_markup=activity_keyboard
+    )
+
+def record_activity(group_id, user_id, user_name, action, start_time, end_time, duration):
+    """Append activity to the group's daily activity log."""
+    success = False
+    try:
+        date_str = clock.today_str()
+        
+        start_time = to_report_time(start_time)
+        end_time = to_report_time(end_time)
+        
+        is_violation = duration > TIME_LIMITS.get(action, float('inf'))
+        violation_status = 'Có' if is_violation else 'Không'
+        violation_duration = duration - TIME_LIMITS.get(action, 0) if is_violation else 0
+        
+        data = {
+            'ID Nhóm': group_id,
+            'ID': user_id,
+            'Tên': user_name,
+            'Hành động': action,
+            'Thời gian bắt đầu': start_time.isoformat(),
+            'Thời gian kết thúc': end_time.isoformat(),
+            'Tổng thời gian (phút)': duration,
+            'Thời gian cho phép (phút)': TIME_LIMITS.get(action, 0),
+            'Vi phạm': violation_status,
+            'Thời gian vi phạm (phút)': violation_duration
+        }
+        
+        if len(report_file_ids):
+            # The day's workbook no longer matches what Telegram has
+            report_file_ids.invalidate(get_group_excel_filename(group_id, date_str))
+        
+        if sqlite_storage is not None:
+            persistence_writer.call(sqlite_storage.insert_activities, [data], date_str)
+            return True
+        
+        excel_filename = get_group_excel_filename(group_id, date_str)
+        log_filename = get_group_log_filename(group_id, date_str)
+        if log_filename not in checked_activity_logs:
+            checked_activity_logs.add(log_filename)
+            persistence_writer.call(seed_activity_log_from_excel, group_id, excel_filename, log_filename)
+        
+        persistence_writer.append(log_filename, json.dumps(data, ensure_ascii=False) + '\n')
+        success = True
+                
+    except Exception as e:
+        logging.error(f"Error in record_activity: {e}")
+        logging.error(f"Group ID: {group_id}, User ID: {user_id}, Action: {action}")
+    return success
+
+def read_excel_rows(group_id, excel_filename):
+    """Read the rows of a workbook written before the activity log existed."""
+    existing_df = pd.read_excel(excel_filename)
+    existing_df = existing_df[existing_df['ID Nhóm'] == group_id]
+    rows = existing_df.to_dict('records')
+    for row in rows:
+        for column in ('Thời gian bắt đầu', 'Thời gian kết thúc'):
+            if isinstance(row.get(column), datetime):
+                row[column] = row[column].isoformat()
+    return rows
+
+def seed_activity_log_from_excel(group_id, excel_filename, log_filename):
+    """Copy rows of a workbook written before the activity log existed into the log."""
+    if os.path.exists(log_filename) or not os.path.exists(excel_filename):
+        return
+    try:
+        rows = read_excel_rows(group_id, excel_filename)
+        with open(log_filename, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+    except Exception as e:
+        logging.error(f"Error reading existing Excel file: {e}")
+
+def read_activity_log(log_filename):
+    """Read all rows of an activity log, skipping damaged lines."""
+    rows = []
+    with open(log_filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                logging.error(f"Skipping damaged line in {log_filename}")
+    return rows
+
+def query_group_activities(group_id, date_str):
+    """Return a group's report rows for a day from the configured storage."""
+    if sqlite_storage is not None:
+        return sqlite_storage.query_group_activities(group_id, date_str)
+    log_filename = get_group_log_filename(group_id, date_str)
+    if not os.path.exists(log_filename):
+        return []
+    return read_activity_log(log_filename)
+
+def group_data_updated_at(group_id, date_str):
+    """Return when a group's stored data for a day last changed (epoch seconds), or None."""
+    if sqlite_storage is not None:
+        return sqlite_storage.last_recorded_at(group_id, date_str)
+    log_filename = get_group_log_filename(group_id, date_str)
+    if not os.path.exists(log_filename):
+        return None
+    return os.path.getmtime(log_filename)
+
+def group_excel_rows(group_id, date_str):
+    """Return (filename, rows) for the group's daily Excel file.
+
+    rows is None when the file is up to date or there is no data for the day;
+    filename is None when there is no file to send.
+    """
+    filename = get_group_excel_filename(group_id, date_str)
+    updated_at = group_data_updated_at(group_id, date_str)
+    
+    if updated_at is None:
+        return (filename if os.path.exists(filename) else None), None
+    if os.path.exists(filename) and os.path.getmtime(filename) > updated_at:
+        return filename, None
+    return filename, query_group_activities(group_id, date_str)
+
+# Builds of one report file are serialized; a build that waited finds the file up to date
+report_build_locks = KeyedLocks('report_file')
+
+async def build_group_excel_offloaded(group_id, date_str):
+    """Build the group's daily Excel file if needed, rendering it in the process pool."""
+    async with report_build_locks.hold(get_group_excel_filename(group_id, date_str)):
+        filename, rows = await asyncio.to_thread(group_excel_rows, group_id, date_str)
+        if rows is None:
+            return filename
+        
+        # Rows are sent to the worker as tuples in EXCEL_COLUMNS order
+        compact_rows = [tuple(row.get(column) for column in EXCEL_COLUMNS) for row in rows]
+        with metrics.timer('bot_excel_build_seconds'):
+            filename = await render_excel(write_group_excel, compact_rows, filename)
+        if filename is not None:
+            metrics.inc('bot_excel_bytes_total', os.path.getsize(filename))
+        return filename
+
+render_pool = None
+# Worker PIDs, reported by each worker on start-up, so a stuck worker can be killed
+render_pool_pids = None
+# One slot per worker: a render waits here, so RENDER_TIMEOUT only runs once a worker has it
+render_slots = asyncio.Semaphore(max(RENDER_WORKERS, 1))
+
+def report_render_worker(pids):
+    """Pool initializer: report this worker's PID to the bot process."""
+    pids.put(os.getpid())
+
+def get_render_pool():
+    """Return the report rendering process pool, creating it on first use (None if disabled)."""
+    global render_pool, render_pool_pids
+    if render_pool is None and RENDER_WORKERS > 0:
+        # Spawned workers import this module without loading any state (see
+        # load_state), on every platform; forking would copy the writer thread's locks
+        context = multiprocessing.get_context('spawn')
+        render_pool_pids = context.SimpleQueue()
+        render_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS, mp_context=context,
+            initializer=report_render_worker, initargs=(render_pool_pids,)
+        )
+    return render_pool
+
+def shutdown_render_pool(kill=False):
+    """Stop the rendering workers; a new pool is created on the next render.
+
+    With kill, the workers are terminated, so one stuck in a render does not
+    keep running after the pool is replaced.
+    """
+    global render_pool, render_pool_pids
+    if render_pool is None:
+        return
+    pool, pids = render_pool, render_pool_pids
+    render_pool = render_pool_pids = None
+    pool.shutdown(wait=False, cancel_futures=True)
+    if kill:
+        while not pids.empty():
+            with contextlib.suppress(OSError):
+                os.kill(pids.get(), signal.SIGTERM)
+    pids.close()
+
+async def render_excel(func, *args):
+    """Run a workbook writer func(*args, filename) in a worker process; return its result.
+
+    If the pool is disabled or broken, or the render times out, the writer
+    runs on a thread of this process instead.
+    """
+    filename = args[-1]
+    if RENDER_WORKERS > 0:
+        try:
+            async with render_slots:
+                future = asyncio.wrap_future(get_render_pool().submit(func, *args))
+                result = await asyncio.wait_for(future, RENDER_TIMEOUT)
+            metrics.inc('bot_excel_renders_total', mode='process')
+            return result
+        except asyncio.TimeoutError:
+            logging.error(f"Rendering {filename} timed out after {RENDER_TIMEOUT}s; rendering locally")
+            metrics.inc('bot_excel_render_fallbacks_total', reason='timeout')
+            # Do not leave a stuck worker running or queue more work behind it
+            shutdown_render_pool(kill=True)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logging.error(f"Report rendering pool failed: {e}; rendering locally")
+            metrics.inc('bot_excel_render_fallbacks_total', reason='broken_pool')
+            shutdown_render_pool()
+        except Exception as e:
+            logging.error(f"Error rendering {filename} in worker: {e}; rendering locally")
+            metrics.inc('bot_excel_render_fallbacks_total', reason=type(e).__name__)
+    
+    result = await asyncio.to_thread(func, *args)
+    metrics.inc('bot_excel_renders_total', mode='local')
+    return result
+
+REPORT_NUMERIC_COLUMNS = ['Tổng thời gian (phút)', 'Thời gian cho phép (phút)', 'Thời gian vi phạm (phút)']
+
+def report_frame(rows):
+    """Build the report DataFrame from stored rows (dicts, or tuples in EXCEL_COLUMNS order)."""
+    df = pd.DataFrame(rows, columns=EXCEL_COLUMNS)
+    df['Thời gian bắt đầu'] = pd.to_datetime(df['Thời gian bắt đầu'], format='ISO8601')
+    df['Thời gian kết thúc'] = pd.to_datetime(df['Thời gian kết thúc'], format='ISO8601')
+    df[REPORT_NUMERIC_COLUMNS] = df[REPORT_NUMERIC_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    return df
+
+def compute_rollup(df):
+    """Reduce a day's report DataFrame to a rollup: totals per (user, action) and starts per hour."""
+    data = df.assign(_violation=(df['Vi phạm'] == 'Có').astype(int))
+    per_user_action = data.groupby(['ID', 'Hành động'], sort=False).agg(**{
+        'Tên': ('Tên', 'last'),
+        'Số lần': ('Tên', 'size'),
+        'Tổng thời gian (phút)': ('Tổng thời gian (phút)', 'sum'),
+        'Số lần vi phạm': ('_violation', 'sum'),
+        'Thời gian vi phạm (phút)': ('Thời gian vi phạm (phút)', 'sum')
+    }).reset_index()[ROLLUP_COLUMNS]
+    hours = pd.crosstab(data['Hành động'], data['Thời gian bắt đầu'].dt.hour)
+    
+    return {
+        'version': ROLLUP_VERSION,
+        'rows': [
+            [int(user_id), name if isinstance(name, str) else None, action,
+             int(count), float(total), int(violations), float(violation_total)]
+            for user_id, name, action, count, total, violations, violation_total
+            in per_user_action.itertuples(index=False, name=None)
+        ],
+        'hours': {
+            action: [int(counts.get(hour, 0)) for hour in range(24)]
+            for action, counts in hours.iterrows()
+        }
+    }
+
+def summarize_rollups(rollups):
+    """Compute the summary sheets of a report from (date_str, rollup) pairs."""
+    frames = [
+        pd.DataFrame(rollup['rows'], columns=ROLLUP_COLUMNS).assign(Ngày=date_str)
+        for date_str, rollup in rollups if rollup['rows']
+    ]
+    data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=ROLLUP_COLUMNS + ['Ngày'])
+    totals = {
+        'Số lần': ('Số lần', 'sum'),
+        'Tổng thời gian (phút)': ('Tổng thời gian (phút)', 'sum'),
+        'Số lần vi phạm': ('Số lần vi phạm', 'sum'),
+        'Thời gian vi phạm (phút)': ('Thời gian vi phạm (phút)', 'sum')
+    }
+    
+    per_user = data.groupby('ID', sort=False).agg(**{'Tên': ('Tên', 'last')}, **totals)
+    per_user = per_user.reset_index().sort_values('Tổng thời gian (phút)', ascending=False)
+    
+    per_action = data.groupby('Hành động').agg(**{'Số người': ('ID', 'nunique')}, **totals)
+    per_action.insert(3, 'Trung bình (phút)', per_action['Tổng thời gian (phút)'] / per_action['Số lần'])
+    per_action = per_action.reset_index().sort_values('Số lần', ascending=False)
+    
+    hour_counts = {}
+    for _, rollup in rollups:
+        for action, counts in rollup['hours'].items():
+            previous = hour_counts.get(action, [0] * 24)
+            hour_counts[action] = [a + b for a, b in zip(previous, counts)]
+    heatmap = pd.DataFrame.from_dict(hour_counts, orient='index', columns=range(24)).sort_index()
+    heatmap.loc['Tổng'] = heatmap.sum()
+    heatmap.columns = [f'{hour:02d}h' for hour in heatmap.columns]
+    heatmap = heatmap.rename_axis('Hành động / Giờ').reset_index()
+    
+    summaries = {'Theo người': per_user, 'Theo hoạt động': per_action}
+    if len(rollups) > 1:
+        per_day = data.groupby('Ngày').agg(**{'Số người': ('ID', 'nunique')}, **totals)
+        per_day = per_day.reindex([date_str for date_str, _ in rollups], fill_value=0).reset_index()
+        per_day['Ngày'] = pd.to_datetime(per_day['Ngày'], format='%Y%m%d').dt.strftime('%d/%m/%Y')
+        summaries['Theo ngày'] = per_day
+    summaries['Theo giờ'] = heatmap
+    return summaries
+
+def write_report_sheet(workbook, name, df, header_format, date_columns=(), date_format=None,
+                       violation_columns=(), violation_format=None):
+    """Stream a DataFrame into a new worksheet row by row (constant-memory safe).
+
+    violation_columns are written in violation_format on rows whose 'Vi phạm' is 'Có'.
+    """
+    worksheet = workbook.add_worksheet(name)
+    worksheet.write_row(0, 0, df.columns, header_format)
+    worksheet.set_column(0, len(df.columns) - 1, 16)
+    for column in date_columns:
+        worksheet.set_column(column, column, 20)
+    
+    violation_index = df.columns.get_loc('Vi phạm') if violation_columns else None
+    values = df.astype(object).where(df.notna(), None)
+    for row_num, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        is_violation = violation_index is not None and row[violation_index] == 'Có'
+        for column, value in enumerate(row):
+            if value is None:
+                continue
+            if column in date_columns:
+                worksheet.write_datetime(row_num, column, value, date_format)
+            elif is_violation and column in violation_columns:
+                worksheet.write(row_num, column, value, violation_format)
+            else:
+                worksheet.write(row_num, column, value)
+    return worksheet
+
+def write_report_workbook(filename, summaries, detail=None, created=None):
+    """Write an optional detail sheet and the summary sheets to an Excel file; return its path.
+
+    created, if given, is stored as the workbook's creation time instead of
+    the current time, so the same data gives the same bytes.
+    """
+    # Unique temp file: a timed-out worker or another thread of this process
+    # may be writing the same report
+    fd, temp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.',
+        prefix=os.path.splitext(os.path.basename(filename))[0] + '.',
+        suffix='.temp.xlsx'
+    )
+    os.close(fd)
+    try:
+        workbook = xlsxwriter.Workbook(temp_filename, {'constant_memory': True})
+        try:
+            if created is not None:
+                workbook.set_properties({'created': created})
+            header_format = workbook.add_format({'bold': True})
+            red_format = workbook.add_format({'font_color': 'red'})
+            date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
             
-            countdown_tasks[user_id] = asyncio.create_task(
-                update_countdown(
-                    user_id=user_id,
-                    chat_id=message.chat_id,
-                    message_id=message.message_id,
-                    action=current_action,
-                    time_limit=TIME_LIMITS[current_action],
-                    context=context
+            if detail is not None:
+                write_report_sheet(
+                    workbook, 'Chi tiết', detail, header_format,
+                    date_columns=[detail.columns.get_loc('Thời gian bắt đầu'), detail.columns.get_loc('Thời gian kết thúc')],
+                    date_format=date_format,
+                    violation_columns=[detail.columns.get_loc('Vi phạm'), detail.columns.get_loc('Thời gian vi phạm (phút)')],
+                    violation_format=red_format
                 )
-            )
-            save_user_states()
+            for name, summary in summaries.items():
+                worksheet = write_report_sheet(workbook, name, summary, header_format)
+                if name == 'Theo giờ':
+                    worksheet.set_column(1, len(summary.columns) - 1, 5)
+                    worksheet.conditional_format(1, 1, len(summary) - 1, len(summary.columns) - 1, {
+                        'type': '2_color_scale',
+                        'min_color': '#FFFFFF',
+                        'max_color': '#F8696B'
+                    })
+        finally:
+            workbook.close()
+    except Exception as e:
+        logging.error(f"Error writing to Excel file: {e}")
+        try:
+            with pd.ExcelWriter(temp_filename, engine='openpyxl') as writer:
+                if detail is not None:
+                    detail.to_excel(writer, index=False, sheet_name='Chi tiết')
+                for name, summary in summaries.items():
+                    summary.to_excel(writer, index=False, sheet_name=name)
+        except Exception as e2:
+            logging.error(f"Error writing to temp file: {e2}")
+            with contextlib.suppress(OSError):
+                os.remove(temp_filename)
+            return filename if os.path.exists(filename) else None
+    os.replace(temp_filename, filename)
+    return filename
 
-async def keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Send keyboard when /keyboard command is issued."""
-    if update.effective_chat.type == 'private':
-        await update.message.reply_text('❌ Bot này chỉ hoạt động trong nhóm.')
-        return
+def write_group_excel(rows, filename):
+    """Write report rows and their summary sheets to an Excel file.
 
-    await update.message.reply_text(
-        '⌨️ Bàn phím hoạt động:',
-        reply_markup=activity_keyboard
+    Returns its path, or None if there are no rows.
+    """
+    df = report_frame(rows)
+    if df.empty:
+        return None
+    return write_report_workbook(filename, summarize_rollups([(None, compute_rollup(df))]), detail=df)
+
+def write_range_excel(rollups, filename):
+    """Write the summary sheets of several days' rollups to an Excel file; return its path."""
+    # Range files are rebuilt on every request; a fixed creation time keeps
+    # unchanged data byte-identical, so its file_id can be reused
+    created = datetime.strptime(rollups[-1][0], "%Y%m%d")
+    return write_report_workbook(filename, summarize_rollups(rollups), created=created)
+
+def get_rollup_filename(group_id, date_str):
+    """Generate the filename of a group's daily rollup."""
+    return os.path.join(ROLLUPS_DIR, f'rollup_group_{group_id}_{date_str}.json')
+
+def load_daily_rollup(group_id, date_str):
+    """Return a stored daily rollup, or None."""
+    if sqlite_storage is not None:
+        text = sqlite_storage.load_rollup(group_id, date_str)
+    else:
+        try:
+            with open(get_rollup_filename(group_id, date_str), 'r', encoding='utf-8') as f:
+                text = f.read()
+        except FileNotFoundError:
+            text = None
+    if text is None:
+        return None
+    rollup = json.loads(text)
+    return rollup if rollup.get('version') == ROLLUP_VERSION else None
+
+def save_daily_rollup(group_id, date_str, rollup):
+    """Queue a daily rollup to be stored."""
+    text = json.dumps(rollup, ensure_ascii=False)
+    if sqlite_storage is not None:
+        persistence_writer.call(sqlite_storage.save_rollup, group_id, date_str, text)
+    else:
+        persistence_writer.replace(get_rollup_filename(group_id, date_str), text)
+
+def daily_rollup(group_id, date_str, closed):
+    """Return a group's rollup for a day, computing it from the stored rows if needed.
+
+    Rollups of closed days are stored, so each is computed only once.
+    """
+    if closed:
+        rollup = load_daily_rollup(group_id, date_str)
+        if rollup is not None:
+            return rollup
+    
+    rows = query_group_activities(group_id, date_str)
+    if not rows and sqlite_storage is None:
+        # Days from before the activity log existed only have a workbook
+        excel_filename = get_group_excel_filename(group_id, date_str)
+        if os.path.exists(excel_filename):
+            rows = read_excel_rows(group_id, excel_filename)
+    if rows:
+        rollup = compute_rollup(report_frame(rows))
+    else:
+        rollup = {'version': ROLLUP_VERSION, 'rows': [], 'hours': {}}
+    
+    if closed:
+        save_daily_rollup(group_id, date_str, rollup)
+    return rollup
+
+def write_daily_rollups(date_str):
+    """Store the rollups of all groups for a closed day; return how many groups had data."""
+    return sum(1 for group_id in list(group_settings) if daily_rollup(group_id, date_str, closed=True)['rows'])
+
+async def write_daily_rollups_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job to store the previous day's rollups after midnight."""
+    try:
+        await persistence_writer.drain()
+        previous_date = (clock.local_now() - timedelta(days=1)).strftime("%Y%m%d")
+        count = await asyncio.to_thread(write_daily_rollups, previous_date)
+        logging.info(f"Stored rollups of {previous_date} for {count} group(s)")
+    except Exception as e:
+        logging.error(f"Error in write_daily_rollups_job: {e}")
+
+def range_rollups(group_id, start_date, end_date):
+    """Return (date_str, rollup) pairs for every day from start_date to end_date."""
+    today_str = clock.today_str()
+    rollups = []
+    day = start_date
+    while day <= end_date:
+        date_str = day.strftime("%Y%m%d")
+        rollups.append((date_str, daily_rollup(group_id, date_str, closed=date_str < today_str)))
+        day += timedelta(days=1)
+    return rollups
+
+async def build_range_excel(group_id, start_date, end_date):
+    """Build a group's report for a range of days from daily rollups.
+
+    Returns the path of the Excel file, or None when there is no data in the range.
+    """
+    rollups = await asyncio.to_thread(range_rollups, group_id, start_date, end_date)
+    if not any(rollup['rows'] for _, rollup in rollups):
+        return None
+    
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    filename = os.path.join(
+        REPORTS_DIR,
+        f'activities_group_{group_id}_{start_date.strftime("%Y%m%d")}_{end_date.strftime("%Y%m%d")}.xlsx'
     )
+    async with report_build_locks.hold(filename):
+        with metrics.timer('bot_excel_build_seconds'):
+            filename = await render_excel(write_range_excel, rollups, filename)
+    if filename is not None:
+        metrics.inc('bot_excel_bytes_total', os.path.getsize(filename))
+    return filename
 
-def record_activity(group_id, user_id, user_name, action, start_time, end_time, duration):
-    """Record activity in Excel file."""
-    success = False
+def parse_report_date(text, today):
+    """Parse a /report date (dd/mm/yyyy, dd/mm, yyyy-mm-dd or yyyymmdd); None if invalid."""
+    for fmt in ('%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    # Parsed with the current year, so 29/02 is accepted in leap years
     try:
-        filename = get_group_excel_filename(group_id)
-        
-        if start_time.tzinfo is not None:
-            start_time = start_time.replace(tzinfo=None)
-        if end_time.tzinfo is not None:
-            end_time = end_time.replace(tzinfo=None)
-        
-        is_violation = duration > TIME_LIMITS.get(action, float('inf'))
-        violation_status = 'Có' if is_violation else 'Không'
-        violation_duration = duration - TIME_LIMITS.get(action, 0) if is_violation else 0
-        
-        data = {
-            'ID Nhóm': group_id,
-            'ID': user_id,
-            'Tên': user_name,
-            'Hành động': action,
-            'Thời gian bắt đầu': start_time,
-            'Thời gian kết thúc': end_time,
-            'Tổng thời gian (phút)': duration,
-            'Thời gian cho phép (phút)': TIME_LIMITS.get(action, 0),
-            'Vi phạm': violation_status,
-            'Thời gian vi phạm (phút)': violation_duration
+        return datetime.strptime(f'{text}/{today.year}', '%d/%m/%Y').date()
+    except ValueError:
+        return None
+
+def parse_report_range(args, today):
+    """Return the (start, end) dates asked for by /report arguments, or None if invalid."""
+    if not args:
+        return today, today
+    if len(args) == 1:
+        keyword = args[0].lower()
+        if keyword in ('week', 'tuan', 'tuần'):
+            return today - timedelta(days=today.weekday()), today
+        if keyword in ('month', 'thang', 'tháng'):
+            return today.replace(day=1), today
+        day = parse_report_date(args[0], today)
+        return (day, day) if day is not None else None
+    if len(args) == 2:
+        start_date = parse_report_date(args[0], today)
+        end_date = parse_report_date(args[1], today)
+        if start_date is None or end_date is None:
+            return None
+        return start_date, end_date
+    return None
+
+class OutboundSender:
+    """Outbound queue for countdown alerts, with per-chat rate limiting.
+
+    Warnings of the same kind for the same chat that arrive within
+    WARNING_COALESCE_WINDOW seconds are merged into one message listing all
+    affected users. Each chat has its own token bucket and priority queue
+    (expiry notices first), drained by a worker task that honours RetryAfter
+    and retries network errors with backoff.
+    """
+
+    def __init__(self, rate=CHAT_SEND_RATE, burst=CHAT_SEND_BURST,
+                 coalesce_window=WARNING_COALESCE_WINDOW, max_attempts=SEND_MAX_ATTEMPTS):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_window = coalesce_window
+        self.max_attempts = max_attempts
+        self.bot = None
+        self.batches = {}
+        self.batch_timers = {}
+        self.queues = {}
+        self.buckets = {}
+        self.workers = {}
+        self.counter = itertools.count()
+
+    def start(self, bot):
+        """Set the bot used for sending."""
+        self.bot = bot
+
+    def pending(self):
+        """Number of messages waiting to be sent."""
+        return sum(len(q) for q in self.queues.values())
+
+    def send_warning(self, chat_id, seconds_left, user_name, action, time_limit,
+                     reply_to_message_id=None, is_valid=None):
+        """Queue a countdown warning; it is merged with others of its kind for the chat."""
+        warning = {
+            'user_name': user_name,
+            'action': action,
+            'time_limit': time_limit,
+            'reply_to_message_id': reply_to_message_id,
+            'is_valid': is_valid
         }
-        
-        df = pd.DataFrame([data])
-        
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        
-        if os.path.exists(filename):
-            try:
-                existing_df = pd.read_excel(filename)
-                existing_df = existing_df[existing_df['ID Nhóm'] == group_id]
-                df = pd.concat([existing_df, df], ignore_index=True)
-            except Exception as e:
-                logging.error(f"Error reading existing Excel file: {e}")
-        
+        key = (chat_id, seconds_left)
+        if key in self.batches:
+            self.batches[key].append(warning)
+            return
+        self.batches[key] = [warning]
+        self.batch_timers[key] = clock.call_later(self.coalesce_window, self._close_batch, key)
+
+    def _close_batch(self, key):
+        self.batch_timers.pop(key, None)
+        warnings = [w for w in self.batches.pop(key, []) if w['is_valid'] is None or w['is_valid']()]
+        if not warnings:
+            return
+        chat_id, seconds_left = key
+        reply_to_message_id = warnings[0]['reply_to_message_id'] if len(warnings) == 1 else None
+        self.enqueue(
+            chat_id,
+            format_countdown_warning(seconds_left, warnings),
+            reply_to_message_id=reply_to_message_id,
+            priority=WARNING_PRIORITY.get(seconds_left, len(WARNING_PRIORITY))
+        )
+
+    def enqueue(self, chat_id, text, reply_to_message_id=None, priority=0):
+        """Queue a message for a chat."""
+        message = {'text': text, 'reply_to_message_id': reply_to_message_id, 'attempts': 0}
+        heapq.heappush(self.queues.setdefault(chat_id, []), (priority, next(self.counter), message))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._drain_chat(chat_id))
+
+    async def _take_token(self, chat_id):
+        tokens, last = self.buckets.get(chat_id, (self.burst, clock.monotonic()))
+        now = clock.monotonic()
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            await clock.sleep((1 - tokens) / self.rate)
+            now = clock.monotonic()
+            tokens = 1
+        self.buckets[chat_id] = (tokens - 1, now)
+
+    async def _drain_chat(self, chat_id):
+        chat_queue = self.queues[chat_id]
         try:
-            with pd.ExcelWriter(filename, engine='xlsxwriter') as writer:
-                df.to_excel(writer, index=False, sheet_name='Sheet1')
-                
-                workbook = writer.book
-                worksheet = writer.sheets['Sheet1']
-                
-                red_format = workbook.add_format({'font_color': 'red'})
-                
-                for row_num, (violation, violation_dur) in enumerate(zip(df['Vi phạm'], df['Thời gian vi phạm (phút)']), start=1):
-                    if violation == 'Có':
-                        worksheet.write(row_num, df.columns.get_loc('Vi phạm'), violation, red_format)
-                        worksheet.write(row_num, df.columns.get_loc('Thời gian vi phạm (phút)'), violation_dur, red_format)
-                    else:
-                        worksheet.write(row_num, df.columns.get_loc('Vi phạm'), violation)
-                        worksheet.write(row_num, df.columns.get_loc('Thời gian vi phạm (phút)'), violation_dur)
-                        
-            success = True
-        except Exception as e:
-            logging.error(f"Error writing to Excel file: {e}")
-            temp_filename = f"{filename}.temp"
+            while chat_queue:
+                await self._take_token(chat_id)
+                priority, seq, message = heapq.heappop(chat_queue)
+                try:
+                    await self.bot.send_message(
+                        chat_id=chat_id,
+                        text=message['text'],
+                        reply_to_message_id=message['reply_to_message_id'],
+                        allow_sending_without_reply=True
+                    )
+                    metrics.inc('bot_outbound_sent_total')
+                except telegram.error.RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    if self._retry(chat_id, priority, seq, message, e):
+                        await clock.sleep(retry_after)
+                except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+                    if self._retry(chat_id, priority, seq, message, e):
+                        await clock.sleep(min(2 ** message['attempts'], 30))
+                except Exception as e:
+                    metrics.inc('bot_outbound_failures_total', reason=type(e).__name__)
+                    logging.error(f"Error sending message to chat {chat_id}: {e}")
+        finally:
+            del self.workers[chat_id]
+            if not chat_queue:
+                del self.queues[chat_id]
+
+    def _retry(self, chat_id, priority, seq, message, error):
+        message['attempts'] += 1
+        if message['attempts'] >= self.max_attempts:
+            metrics.inc('bot_outbound_failures_total', reason=type(error).__name__)
+            logging.error(f"Giving up sending message to chat {chat_id} after {message['attempts']} attempts: {error}")
+            return False
+        metrics.inc('bot_outbound_retries_total', reason=type(error).__name__)
+        heapq.heappush(self.queues[chat_id], (priority, seq, message))
+        return True
+
+    async def stop(self, timeout=10):
+        """Send open warning batches and wait briefly for queued messages."""
+        for key, timer in list(self.batch_timers.items()):
+            timer.cancel()
+            self._close_batch(key)
+        workers = list(self.workers.values())
+        if workers:
+            done, pending = await asyncio.wait(workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+outbound_sender = OutboundSender()
+metrics.gauge('bot_outbound_pending', outbound_sender.pending, 'Countdown alerts waiting to be sent')
+
+def format_countdown_warning(seconds_left, warnings):
+    """Build the text of a countdown warning for one or several users."""
+    if len(warnings) == 1:
+        action = warnings[0]['action']
+        if seconds_left == 60:
+            return f"⚠️⏳ CẢNH BÁO: Hoạt động {action} còn 1 phút nữa sẽ hết thời gian cho phép!"
+        if seconds_left == 20:
+            return f'🚨 CẢNH BÁO KHẨN CẤP: Hoạt động {action} chỉ còn 20 giây nữa!\nẤn quay về ngay lập tức!'
+        return (
+            f'⏰ ĐÃ HẾT THỜI GIAN CHO PHÉP!\nHoạt động: {action}\n'
+            f'Thời gian cho phép: {warnings[0]["time_limit"]} phút\n'
+            'Vui lòng ấn nút "Quay về" để kết thúc hoạt động.'
+        )
+    
+    lines = [f"- {w['user_name']}: {w['action']}" for w in warnings]
+    if seconds_left == 60:
+        return "⚠️⏳ CẢNH BÁO: Còn 1 phút nữa sẽ hết thời gian cho phép!\n" + '\n'.join(lines)
+    if seconds_left == 20:
+        return '🚨 CẢNH BÁO KHẨN CẤP: Chỉ còn 20 giây nữa!\n' + '\n'.join(lines) + '\nẤn quay về ngay lập tức!'
+    lines = [f"- {w['user_name']}: {w['action']} ({w['time_limit']} phút)" for w in warnings]
+    return (
+        '⏰ ĐÃ HẾT THỜI GIAN CHO PHÉP!\n' + '\n'.join(lines) +
+        '\nVui lòng ấn nút "Quay về" để kết thúc hoạt động.'
+    )
+
+class CountdownScheduler:
+    """Single task that sends countdown warnings for all active users.
+
+    Pending warnings live in one min-heap ordered by due time. Cancelling a
+    user's countdown only marks its heap entries; they are dropped when they
+    reach the top of the heap, or all at once when they make up most of it.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.countdowns = {}
+        self.cancelled = 0
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+
+    def __len__(self):
+        """Number of users with a running countdown."""
+        return len(self.entries)
+
+    def start(self):
+        """Start the scheduler task on the running event loop."""
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the scheduler task."""
+        if self.task is not None:
+            self.task.cancel()
             try:
-                df.to_excel(temp_filename, index=False)
-                if os.path.exists(filename):
-                    os.remove(filename)
-                os.rename(temp_filename, filename)
-                success = True
-            except Exception as e2:
-                logging.error(f"Error writing to temp file: {e2}")
-                
-    except Exception as e:
-        logging.error(f"Error in record_activity: {e}")
-        logging.error(f"Group ID: {group_id}, User ID: {user_id}, Action: {action}")
-    return success
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
 
-async def update_countdown(user_id, chat_id, message_id, action, time_limit, context):
-    """Update countdown timer."""
-    try:
-        if user_id not in user_states:
-            return
-        
-        start_time = user_states[user_id]['start_time']
-        end_time = start_time + timedelta(minutes=time_limit)
-        now = datetime.now()
-        
-        remaining = (end_time - now).total_seconds()
+    def schedule(self, user_id, user_name, chat_id, message_id, action, start_time, time_limit):
+        """Arm the warnings and the expiry notice for a user's activity."""
+        self.cancel(user_id)
+        start_time = to_report_time(start_time)
+        deadline = start_time + timedelta(minutes=time_limit)
+        now = clock.now()
+        countdown = {
+            'user_name': user_name,
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'action': action,
+            'time_limit': time_limit,
+            'start_time': start_time
+        }
         
-        if remaining > 60:
-            wait_time = remaining - 60
-            await asyncio.sleep(wait_time)
+        entries = []
+        for seconds_left in COUNTDOWN_WARNINGS + (0,):
+            due = deadline - timedelta(seconds=seconds_left)
+            if seconds_left and due <= now:
+                continue
+            entry = [due, next(self.counter), user_id, seconds_left, countdown]
+            heapq.heappush(self.heap, entry)
+            entries.append(entry)
+        self.entries[user_id] = entries
+        self.countdowns[user_id] = countdown
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def cancel(self, user_id):
+        """Drop all pending warnings of a user."""
+        self.countdowns.pop(user_id, None)
+        for entry in self.entries.pop(user_id, ()):
+            entry[2] = None
+            self.cancelled += 1
+        if self.cancelled > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if entry[2] is not None]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    async def run(self):
+        while True:
+            while self.heap and self.heap[0][2] is None:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
             
-            if user_id not in user_states or user_states[user_id]['status'] != 'active':
-                return
-                
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"⚠️⏳ CẢNH BÁO: Hoạt động {action} còn 1 phút nữa sẽ hết thời gian cho phép!",
-                reply_to_message_id=message_id
-            )
-            remaining = 60
-        
-        if remaining > 20:
-            wait_time = remaining - 20
-            await asyncio.sleep(wait_time)
+            timeout = None
+            if self.heap:
+                timeout = (self.heap[0][0] - clock.now()).total_seconds()
+                if timeout <= 0:
+                    entry = heapq.heappop(self.heap)
+                    self.fire(entry)
+                    continue
             
-            if user_id not in user_states or user_states[user_id]['status'] != 'active':
-                return
-                
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f'🚨 CẢNH BÁO KHẨN CẤP: Hoạt động {action} chỉ còn 20 giây nữa!\nẤn quay về ngay lập tức!',
-                reply_to_message_id=message_id
-            )
-            remaining = 20
+            self.wakeup.clear()
+            await clock.wait_event(self.wakeup, timeout)
+
+    def fire(self, entry):
+        """Send the warning of a due heap entry."""
+        _, _, user_id, seconds_left, countdown = entry
+        entries = self.entries.get(user_id)
+        if entries is not None:
+            entries.remove(entry)
+            if not entries:
+                del self.entries[user_id]
         
-        await asyncio.sleep(remaining)
+        if not self.is_current(user_id, countdown) or live_board_enabled(countdown['chat_id']):
+            return
         
-        if user_id in user_states and user_states[user_id]['status'] == 'active':
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f'⏰ ĐÃ HẾT THỜI GIAN CHO PHÉP!\nHoạt động: {action}\nThời gian cho phép: {time_limit} phút\nVui lòng ấn nút "Quay về" để kết thúc hoạt động.',
-                reply_to_message_id=message_id
-            )
-            
-    except Exception as e:
-        logging.error(f"Error in update_countdown: {e}")
+        outbound_sender.send_warning(
+            chat_id=countdown['chat_id'],
+            seconds_left=seconds_left,
+            user_name=countdown['user_name'],
+            action=countdown['action'],
+            time_limit=countdown['time_limit'],
+            reply_to_message_id=countdown['message_id'],
+            is_valid=lambda: self.is_current(user_id, countdown)
+        )
+
+    def is_current(self, user_id, countdown):
+        """Whether the user is still in the activity a countdown was armed for."""
+        state = user_states.get(user_id)
+        return (
+            self.countdowns.get(user_id) is countdown
+            and state is not None
+            and state['status'] == 'active'
+        )
+
+countdown_scheduler = CountdownScheduler()
+metrics.gauge('bot_live_countdowns', lambda: len(countdown_scheduler), 'Users with a running countdown')
+
+class MemberNameCache:
+    """TTL cache of (chat_id, user_id) -> display name.
 
+    Filled from the updates the bot receives anyway; names still missing are
+    looked up with getChatMember, a few at a time. The least recently used
+    entries are dropped beyond max_size.
+    """
+
+    def __init__(self, ttl=MEMBER_NAME_TTL, max_size=MEMBER_NAME_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, chat_id, user_id):
+        """Return the cached name, or None if it is missing or expired."""
+        key = (chat_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        name, expires = entry
+        if expires < clock.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return name
+
+    def put(self, chat_id, user_id, name):
+        """Remember a member's display name."""
+        if not name:
+            return
+        key = (chat_id, user_id)
+        self.entries[key] = (name, clock.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def resolve(self, bot, chat_id, user_ids, concurrency=MEMBER_LOOKUP_CONCURRENCY):
+        """Return {user_id: name or None}, looking up cache misses concurrently."""
+        names = {user_id: self.get(chat_id, user_id) for user_id in user_ids}
+        misses = [user_id for user_id, name in names.items() if name is None]
+        metrics.inc('bot_member_name_lookups_total', len(names) - len(misses), result='hit')
+        metrics.inc('bot_member_name_lookups_total', len(misses), result='miss')
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def lookup(user_id):
+            async with semaphore:
+                try:
+                    chat_member = await bot.get_chat_member(chat_id, user_id)
+                except Exception as e:
+                    logging.warning(f"Cannot look up member {user_id} of chat {chat_id}: {e}")
+                    return
+            names[user_id] = chat_member.user.full_name
+            self.put(chat_id, user_id, names[user_id])
+
+        await asyncio.gather(*(lookup(user_id) for user_id in misses))
+        return names
+
+member_names = MemberNameCache()
+metrics.gauge('bot_member_names_cached', lambda: len(member_names), 'Member display names in the cache')
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ReportFileCache:
+    """Telegram file_ids of report files that were already uploaded, keyed by path.
+
+    An entry is reused while the file keeps its modification time and size,
+    or, when those changed, its content hash. record_activity drops the entry
+    of a day's workbook as soon as its data changes. The least recently used
+    entries are dropped beyond max_size.
+    """
+
+    def __init__(self, max_size=REPORT_FILE_ID_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, path):
+        """Return (file_id or None, signature) of a report file; pass the signature to put()."""
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            self.entries.move_to_end(path)
+            return entry[3], entry[:3]
+        signature = (stat.st_mtime_ns, stat.st_size, file_digest(path))
+        if entry is not None and entry[2] == signature[2]:
+            self.entries[path] = signature + (entry[3],)
+            self.entries.move_to_end(path)
+            return entry[3], signature
+        return None, signature
+
+    def put(self, path, signature, file_id):
+        """Remember the file_id Telegram returned for an upload of a file."""
+        self.entries[path] = signature + (file_id,)
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, path):
+        """Forget a file whose content is about to change."""
+        self.entries.pop(path, None)
+
+report_file_ids = ReportFileCache()
+metrics.gauge('bot_report_file_ids_cached', lambda: len(report_file_ids), 'Report file_ids kept for re-sending')
+
+async def send_report_document(send, path, filename, **kwargs):
+    """Send a report file with send(document=..., **kwargs) and return the sent message.
+
+    A file that was uploaded before and has not changed is sent by its
+    Telegram file_id instead of being uploaded again.
+    """
+    file_id, signature = report_file_ids.lookup(path)
+    if file_id is not None:
+        try:
+            message = await send(document=file_id, **kwargs)
+            metrics.inc('bot_report_uploads_total', mode='file_id')
+            return message
+        except telegram.error.BadRequest as e:
+            logging.warning(f"Cannot re-send {filename} by file_id, uploading it: {e}")
+            report_file_ids.invalidate(path)
+    
+    with open(path, 'rb') as f:
+        message = await send(document=f, filename=filename, **kwargs)
+    metrics.inc('bot_report_uploads_total', mode='upload')
+    document = getattr(message, 'document', None)
+    if document is not None:
+        report_file_ids.put(path, signature, document.file_id)
+    return message
+
+class OccupancyIndex:
+    """Number of users currently in each activity of each group.
+
+    Updated on start and stop, so occupancy limits are checked without
+    scanning user_states. The key '*' counts all activities of a group.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.places = {}
+
+    def __len__(self):
+        """Number of users in an activity."""
+        return len(self.places)
+
+    def add(self, user_id, chat_id, action):
+        """Count a user as in an activity of a group."""
+        self.remove(user_id)
+        self.places[user_id] = (chat_id, action)
+        for key in ((chat_id, action), (chat_id, '*')):
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def remove(self, user_id):
+        """Stop counting a user."""
+        place = self.places.pop(user_id, None)
+        if place is None:
+            return
+        chat_id, action = place
+        for key in ((chat_id, action), (chat_id, '*')):
+            self.counts[key] -= 1
+            if not self.counts[key]:
+                del self.counts[key]
+
+    def count(self, chat_id, action='*'):
+        """Number of users in an activity of a group ('*' for any activity)."""
+        return self.counts.get((chat_id, action), 0)
+
+occupancy = OccupancyIndex()
+metrics.gauge('bot_active_users', lambda: len(occupancy), 'Users currently in an activity')
+
+def check_activity_limits(group_id, user_id, action, date_str):
+    """Return why a group's limits refuse starting an action now, or None if it is allowed.
+
+    Checks the occupancy limits (people in an activity at once) and the user's
+    daily quotas (minutes per day; '*' covers all activities) from group_settings.
+    An activity only starts if its whole time limit fits in what is left of a quota.
+    """
+    settings = group_settings.get(group_id)
+    if not settings:
+        return None
+    
+    limits = settings.get('occupancy_limits') or {}
+    for key in (action, '*'):
+        limit = limits.get(key)
+        count = occupancy.count(group_id, key)
+        if limit and count >= limit:
+            metrics.inc('bot_activity_rejections_total', reason='occupancy')
+            label = action if key != '*' else 'ra ngoài'
+            return f'⛔ Đang có {count}/{limit} người {label}. Vui lòng đợi người khác quay về.'
+    
+    quotas = settings.get('daily_quotas') or {}
+    if quotas:
+        stats = daily_stats.get((user_id, date_str), EMPTY_DAILY_STATS)
+        for key in (action, '*'):
+            quota = quotas.get(key)
+            if not quota:
+                continue
+            used = stats['total_duration'] if key == '*' else stats['action_minutes'].get(action, 0)
+            if used + TIME_LIMITS[action] > quota:
+                metrics.inc('bot_activity_rejections_total', reason='quota')
+                label = f'cho {action}' if key != '*' else 'cho tất cả hoạt động'
+                return (
+                    f'⛔ Bạn đã dùng {used:.0f}/{quota} phút {label} trong hôm nay, '
+                    f'không đủ cho {TIME_LIMITS[action]} phút của {action}.'
+                )
+    return None
+
+def parse_limit_action(words):
+    """Match /setlimit and /setquota action words to an action name, '*' for all; None if unknown."""
+    text = ' '.join(words).strip().lower()
+    if text in ('all', '*', 'tất cả', 'tat ca'):
+        return '*'
+    matches = [action for action in TIME_LIMITS if action.lower() == text]
+    if not matches:
+        matches = [action for action in TIME_LIMITS if text and text in action.lower()]
+    return matches[0] if len(matches) == 1 else None
+
+def live_board_enabled(chat_id):
+    """Whether a group shows its active users on a pinned live board."""
+    return bool(group_settings.get(chat_id, {}).get('live_board'))
+
+def format_live_board(members, now):
+    """Build the text of a live board from {user_id: (name, action, start_time, time_limit)}."""
+    if not members:
+        return '📋 ĐANG RA NGOÀI\n━━━━━━━━━━━━━━━━━━━━\n✅ Không có ai đang ra ngoài.'
+    ordered = sorted(members.values(), key=lambda member: member[2])
+    lines = [f'📋 ĐANG RA NGOÀI ({len(ordered)})', '━━━━━━━━━━━━━━━━━━━━']
+    for index, (name, action, start_time, time_limit) in enumerate(ordered[:LIVE_BOARD_MAX_LINES], 1):
+        # Whole minutes, so the text changes at most once a minute per user
+        seconds_left = (start_time + timedelta(minutes=time_limit) - now).total_seconds()
+        if seconds_left >= 0:
+            remaining = f'còn {int(-(-seconds_left // 60))} phút'
+        else:
+            remaining = f'⏰ quá {int(-seconds_left // 60) + 1} phút'
+        lines.append(f'{index}. {name} - {action} - {remaining}')
+    if len(ordered) > LIVE_BOARD_MAX_LINES:
+        lines.append(f'... và {len(ordered) - LIVE_BOARD_MAX_LINES} người khác')
+    return '\n'.join(lines)
+
+class LiveBoard:
+    """One pinned message per group listing its active users, edited in place.
+
+    Start and stop only update the in-memory list of each group's active
+    users. A single task re-renders the boards every LIVE_BOARD_INTERVAL
+    seconds and edits a board only when its text changed, so the number of
+    outbound calls depends on the tick rate, not on how many people are out.
+    In groups with the board turned on, starts get no reply and countdown
+    warnings are not sent.
+    """
+
+    def __init__(self, interval=LIVE_BOARD_INTERVAL):
+        self.interval = interval
+        self.members = {}
+        self.texts = {}
+        self.retry_at = {}
+        self.bot = None
+        self.task = None
+
+    def start(self, bot):
+        """Start the refresh task on the running event loop."""
+        self.bot = bot
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the refresh task."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def add(self, chat_id, user_id, user_name, action, start_time, time_limit):
+        """Show a user's running activity on the group's board."""
+        start_time = to_report_time(start_time)
+        self.members.setdefault(chat_id, {})[user_id] = (user_name, action, start_time, time_limit)
+
+    def remove(self, chat_id, user_id):
+        """Take a user off the group's board."""
+        members = self.members.get(chat_id)
+        if members is not None:
+            members.pop(user_id, None)
+            if not members:
+                del self.members[chat_id]
+
+    async def run(self):
+        while True:
+            await clock.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Error refreshing live boards: {e}")
+
+    async def refresh(self):
+        """Edit the boards whose text changed since the last tick."""
+        now = clock.now()
+        updates = []
+        for chat_id, settings in list(group_settings.items()):
+            if not settings.get('live_board') or self.retry_at.get(chat_id, 0) > clock.monotonic():
+                continue
+            text = format_live_board(self.members.get(chat_id, {}), now)
+            if text != self.texts.get(chat_id) or not settings.get('live_board_message_id'):
+                updates.append(self.publish(chat_id, settings, text))
+        await asyncio.gather(*updates)
+
+    async def publish(self, chat_id, settings, text):
+        """Edit a group's board, or send and pin a new one if it has none.
+
+        Runs under the group's lock, like /liveboard, so turning the board off
+        cannot interleave with a send.
+        """
+        async with group_locks.hold(chat_id):
+            if not settings.get('live_board'):
+                return
+            message_id = settings.get('live_board_message_id')
+            try:
+                if message_id:
+                    try:
+                        await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                        metrics.inc('bot_live_board_edits_total', result='edited')
+                    except telegram.error.BadRequest as e:
+                        if 'not modified' not in str(e).lower():
+                            # The board was deleted; a new one is sent on the next tick
+                            logging.warning(f"Cannot edit live board of chat {chat_id}: {e}")
+                            settings.pop('live_board_message_id', None)
+                            save_group_settings()
+                            return
+                        metrics.inc('bot_live_board_edits_total', result='unchanged')
+                else:
+                    message = await self.bot.send_message(chat_id=chat_id, text=text)
+                    if not settings.get('live_board'):
+                        # Turned off while the message was being sent
+                        await self.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+                        return
+                    settings['live_board_message_id'] = message.message_id
+                    save_group_settings()
+                    metrics.inc('bot_live_board_edits_total', result='sent')
+                    try:
+                        await self.bot.pin_chat_message(
+                            chat_id=chat_id, message_id=message.message_id, disable_notification=True
+                        )
+                    except telegram.error.TelegramError as e:
+                        logging.warning(f"Cannot pin live board in chat {chat_id}: {e}")
+                self.texts[chat_id] = text
+            except telegram.error.RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.retry_at[chat_id] = clock.monotonic() + retry_after
+                metrics.inc('bot_live_board_edits_total', result='retry_after')
+            except Exception as e:
+                metrics.inc('bot_live_board_edits_total', result=type(e).__name__)
+                logging.error(f"Error updating live board of chat {chat_id}: {e}")
+
+live_board = LiveBoard()
+
+def restore_countdowns():
+    """Re-arm countdowns of users that were active when the bot stopped."""
+    restored = 0
+    for user_id, state in user_states.items():
+        if state['status'] != 'active' or state['start_time'] is None or state['action'] not in TIME_LIMITS:
+            continue
+        if state.get('chat_id') is None:
+            logging.warning(f"Cannot restore countdown of user {user_id}: chat unknown")
+            continue
+        countdown_scheduler.schedule(
+            user_id=user_id,
+            user_name=state.get('full_name') or f'ID {user_id}',
+            chat_id=state['chat_id'],
+            message_id=state.get('message_id'),
+            action=state['action'],
+            start_time=state['start_time'],
+            time_limit=TIME_LIMITS[state['action']]
+        )
+        live_board.add(
+            state['chat_id'], user_id, state.get('full_name') or f'ID {user_id}',
+            state['action'], state['start_time'], TIME_LIMITS[state['action']]
+        )
+        occupancy.add(user_id, state['chat_id'], state['action'])
+        restored += 1
+    if restored:
+        logging.info(f"Restored {restored} countdown(s)")
+
+metrics_server = None
+
+async def post_init(application: Application):
+    """Start background services once the application is initialized."""
+    global metrics_server
+    if METRICS_PORT:
+        metrics_server = LocalHTTPServer(METRICS_HOST, int(METRICS_PORT), {('GET', '/metrics'): metrics_endpoint})
+        await metrics_server.start()
+    outbound_sender.start(application.bot)
+    countdown_scheduler.start()
+    restore_countdowns()
+    live_board.start(application.bot)
+
+async def post_shutdown(application: Application):
+    """Stop background services."""
+    await countdown_scheduler.stop()
+    await live_board.stop()
+    await outbound_sender.stop()
+    shutdown_render_pool()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+@instrumented('report')
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Generate and send daily report."""
+    """Generate and send the report of a day or a range of days (today by default)."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     
@@ -591,76 +3429,180 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('❌ Chỉ admin hoặc superadmin mới có thể sử dụng lệnh này.')
         return
 
-    current_date = datetime.now().strftime("%Y%m%d")
-    filename = f'activities_group_{chat_id}_{current_date}.xlsx'
-    full_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports', filename)
+    today = clock.local_now().date()
+    date_range = parse_report_range(context.args or [], today)
+    if date_range is None:
+        await update.message.reply_text(
+            '❌ Cú pháp không hợp lệ. Sử dụng:\n'
+            '/report - báo cáo hôm nay\n'
+            '/report dd/mm/yyyy - báo cáo một ngày\n'
+            '/report dd/mm/yyyy dd/mm/yyyy - báo cáo từ ngày đến ngày\n'
+            '/report week - báo cáo tuần này\n'
+            '/report month - báo cáo tháng này'
+        )
+        return
+    start_date, end_date = date_range
+    if start_date > end_date or end_date > today:
+        await update.message.reply_text('❌ Khoảng thời gian không hợp lệ.')
+        return
+    if (end_date - start_date).days + 1 > MAX_REPORT_RANGE_DAYS:
+        await update.message.reply_text(f'❌ Chỉ có thể xem báo cáo tối đa {MAX_REPORT_RANGE_DAYS} ngày.')
+        return
+
+    await persistence_writer.drain()
+    try:
+        if start_date == end_date:
+            full_path = await build_group_excel_offloaded(chat_id, start_date.strftime("%Y%m%d"))
+            period = 'hôm nay' if start_date == today else start_date.strftime('%d/%m/%Y')
+            caption = f'📊 Báo cáo hoạt động ngày {period}'
+            no_data = '📊 Chưa có dữ liệu hoạt động nào trong ngày.'
+        else:
+            full_path = await build_range_excel(chat_id, start_date, end_date)
+            caption = f"📊 Báo cáo hoạt động từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}"
+            no_data = '📊 Không có dữ liệu hoạt động nào trong khoảng thời gian này.'
+    except Exception as e:
+        logging.error(f"Error building report: {e}")
+        await update.message.reply_text('❌ Có lỗi xảy ra khi tạo báo cáo. Vui lòng thử lại sau.')
+        return
     
-    if not os.path.exists(full_path):
-        await update.message.reply_text('📊 Chưa có dữ liệu hoạt động nào trong ngày.')
+    if full_path is None:
+        await update.message.reply_text(no_data)
         return
         
+    filename = os.path.basename(full_path)
     if filename.startswith('~$'):
-        await update.message.reply_text('📊 Chưa có dữ liệu hoạt động nào trong ngày.')
+        await update.message.reply_text(no_data)
         return
 
     group_name = group_settings[chat_id]['group_name']
     try:
-        with open(full_path, 'rb') as f:
-            await update.message.reply_document(
-                document=f,
-                filename=filename,
-                caption=f'📊 Báo cáo hoạt động ngày hôm nay - Nhóm {group_name}'
-            )
+        await send_report_document(
+            update.message.reply_document, full_path, filename,
+            caption=f'{caption} - Nhóm {group_name}'
+        )
     except Exception as e:
         logging.error(f"Error sending report: {e}")
         await update.message.reply_text('❌ Có lỗi xảy ra khi gửi báo cáo. Vui lòng thử lại sau.')
 
-async def send_daily_reports_job(context: ContextTypes.DEFAULT_TYPE):
-    """Job to send daily reports."""
+@instrumented('metrics')
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the runtime metrics summary (superadmin only)."""
+    if not is_superadmin(update.effective_user.id, update.effective_chat.id):
+        await update.message.reply_text('❌ Chỉ superadmin mới có thể sử dụng lệnh này.')
+        return
+    
+    await update.message.reply_text('📈 Số liệu vận hành:\n' + (metrics.summary() or 'Chưa có dữ liệu.'))
+
+async def send_group_report(bot, group_id, settings, current_date, semaphore):
+    """Send one group's daily report, retrying failed uploads.
+
+    Returns 'sent', 'failed' or 'skipped'.
+    """
     try:
-        current_date = datetime.now().strftime("%Y%m%d")
+        if not settings['is_setup']:
+            return 'skipped'
+            
+        group_name = settings['group_name']
+        report_group_id = settings.get('report_group_id')
         
-        for group_id, settings in group_settings.items():
-            try:
-                if not settings['is_setup']:
-                    continue
-                    
-                group_name = settings['group_name']
-                report_group_id = settings.get('report_group_id')
-                
-                if not report_group_id:
-                    continue
-                
-                filename = f'activities_group_{group_id}_{current_date}.xlsx'
-                full_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports', filename)
-                
-                if not os.path.exists(full_path):
-                    continue
-                    
-                if filename.startswith('~$'):
-                    continue
+        if not report_group_id:
+            return 'skipped'
+        
+        async with semaphore:
+            full_path = await build_group_excel_offloaded(group_id, current_date)
+            
+            if full_path is None:
+                return 'skipped'
                 
+            filename = os.path.basename(full_path)
+            if filename.startswith('~$'):
+                return 'skipped'
+            
+            for attempt in range(1, REPORT_SEND_ATTEMPTS + 1):
                 try:
-                    with open(full_path, 'rb') as f:
-                        await context.bot.send_document(
-                            chat_id=report_group_id,
-                            document=f,
-                            filename=filename,
-                            caption=f'📊 Báo cáo hoạt động ngày {current_date} - Nhóm {group_name}'
-                        )
-                except Exception as e:
+                    await send_report_document(
+                        functools.partial(bot.send_document, chat_id=report_group_id), full_path, filename,
+                        caption=f'📊 Báo cáo hoạt động ngày {current_date} - Nhóm {group_name}'
+                    )
+                    return 'sent'
+                except telegram.error.RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    error = e
+                except (telegram.error.BadRequest, telegram.error.Forbidden) as e:
                     logging.error(f"Error sending report to group {group_name}: {e}")
-                
-            except Exception as e:
-                logging.error(f"Error processing group {group_id}: {e}")
-                continue
-                
+                    return 'failed'
+                except Exception as e:
+                    delay = 2 ** attempt
+                    error = e
+                logging.warning(f"Error sending report to group {group_name} (attempt {attempt}/{REPORT_SEND_ATTEMPTS}): {error}")
+                if attempt < REPORT_SEND_ATTEMPTS:
+                    await clock.sleep(delay)
+            logging.error(f"Error sending report to group {group_name}: {error}")
+            return 'failed'
+    except Exception as e:
+        logging.error(f"Error processing group {group_id}: {e}")
+        return 'failed'
+
+async def send_daily_reports_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job to send daily reports."""
+    summary = {'sent': [], 'failed': [], 'skipped': []}
+    started = timer_clock()
+    try:
+        current_date = clock.today_str()
+        await persistence_writer.drain()
+        
+        semaphore = asyncio.Semaphore(REPORT_SEND_CONCURRENCY)
+        groups = list(group_settings.items())
+        results = await asyncio.gather(*(
+            send_group_report(context.bot, group_id, settings, current_date, semaphore)
+            for group_id, settings in groups
+        ))
+        for (group_id, _), result in zip(groups, results):
+            summary[result].append(group_id)
+            metrics.inc('bot_daily_reports_total', result=result)
+        
+        logging.info(
+            f"Daily reports {current_date}: {len(summary['sent'])} sent, "
+            f"{len(summary['failed'])} failed, {len(summary['skipped'])} skipped"
+        )
+        if summary['failed']:
+            logging.error(f"Daily reports failed for groups: {summary['failed']}")
     except Exception as e:
         logging.error(f"Error in send_daily_reports_job: {e}")
+    metrics.observe('bot_daily_report_seconds', timer_clock() - started)
+    return summary
+
+def load_state():
+    """Open the storage and load group settings, user states and daily totals.
+
+    Called once at startup rather than on import, so that report workers and
+    the offline tools can import this module without touching any state.
+    """
+    global sqlite_storage, group_settings, user_states
+    if STORAGE_BACKEND == 'sqlite':
+        sqlite_storage = SQLiteStorage(SQLITE_DB_FILE)
+    migrate_files_to_sqlite()
+    group_settings = load_group_settings()
+    user_states = load_user_states()
+    rebuild_daily_stats()
 
 def main():
     """Start the bot."""
-    application = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+    if UPDATE_MODE == 'webhook' and not WEBHOOK_SECRET:
+        logging.error("WEBHOOK_SECRET must be set in webhook mode")
+        return
+    
+    load_state()
+    application = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_TOKEN'))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("report", report))
@@ -668,10 +3610,15 @@ def main():
     application.add_handler(CommandHandler("removeadmin", remove_admin))
     application.add_handler(CommandHandler("listadmin", list_admins))
     application.add_handler(CommandHandler("keyboard", keyboard))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_activity_button))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("liveboard", liveboard_command))
+    application.add_handler(CommandHandler("setlimit", set_limit_command))
+    application.add_handler(CommandHandler("setquota", set_quota_command))
+    application.add_handler(CommandHandler("limits", limits_command))
+    application.add_handler(MessageHandler(filters.Text(ACTIVITY_BUTTON_LABELS), handle_activity_button))
 
     # Lên lịch gửi báo cáo lúc 23:59 mỗi ngày (UTC+7)
-    utc_plus_7 = pytz.timezone('Asia/Bangkok')
+    utc_plus_7 = REPORT_TIMEZONE
     report_time = time(hour=22, minute=18, second=0, tzinfo=utc_plus_7)
     
     application.job_queue.run_daily(
@@ -685,7 +3632,39 @@ def main():
         }
     )
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Gộp nhật ký trạng thái vào snapshot định kỳ
+    application.job_queue.run_repeating(
+        compact_user_states_job,
+        interval=JOURNAL_COMPACT_INTERVAL,
+        first=JOURNAL_COMPACT_INTERVAL,
+        name='compact_user_states'
+    )
+
+    # Lưu bảng tổng hợp của ngày hôm trước cho báo cáo nhiều ngày
+    application.job_queue.run_daily(
+        write_daily_rollups_job,
+        time=time(hour=0, minute=1, second=0, tzinfo=utc_plus_7),
+        name='write_daily_rollups',
+        days=(0, 1, 2, 3, 4, 5, 6)
+    )
+
+    # Chuyển lịch sử ngày cũ vào archive sau nửa đêm
+    application.job_queue.run_daily(
+        archive_old_activities_job,
+        time=time(hour=0, minute=0, second=30, tzinfo=utc_plus_7),
+        name='archive_old_activities',
+        days=(0, 1, 2, 3, 4, 5, 6)
+    )
+
+    archived = archive_old_activities()
+    if evict_idle_users() or not archived:
+        compact_user_states()
+    if UPDATE_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    compact_user_states()
+    persistence_writer.stop()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,292 @@
+"""Accelerated simulation of a full day of button presses on a virtual clock.
+
+Replays a generated day (activity starts, check-outs, countdown warnings,
+the nightly report, and the archive/rollup jobs after midnight) through the
+real handlers of bot.py with bot.clock replaced by a VirtualClock, so 24
+hours run in seconds. It then checks the outcome against the schedule:
+- every countdown warning fired exactly at its due time, and only for activities still running
+- one log row per check-out, with the right violation flag
+- the daily totals
+- one report per group
+- the archive and the rollups after midnight
+- that a check-out after midnight in REPORT_TIMEZONE goes to the new day and
+  is found by /report, with the process running in another timezone
+  (--server-tz, where the platform can set it)
+
+It also reports throughput.
+
+    python simulate_day.py --users 200 --groups 4 --activities 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta, date
+from types import SimpleNamespace
+
+from benchmark import BOT_DIR, StubBot, make_update, percentile
+
+# Working hours in which activities are scheduled
+DAY_START_HOUR = 8
+DAY_END_HOUR = 21
+# Nightly jobs, as scheduled in bot.main()
+REPORT_TIME = (22, 18, 0)
+ARCHIVE_TIME = (0, 0, 30)
+ROLLUP_TIME = (0, 1, 0)
+# Admin of every simulated group, who requests the reports
+ADMIN_ID = 1
+
+
+def build_schedule(rng, actions, time_limits, members, activities, day):
+    """Plan each member's activities for the day.
+
+    Returns a list of dicts with the user, action, start time and duration in
+    whole seconds. Activities of one user never overlap.
+    """
+    planned = []
+    window = (DAY_END_HOUR - DAY_START_HOUR) * 3600
+    slot = window // activities
+    for user_id, full_name, chat_id in members:
+        for index in range(activities):
+            action = rng.choice(actions)
+            limit = time_limits[action] * 60
+            # Most activities end in time, some run into the warnings or past the limit
+            duration = int(limit * rng.uniform(0.3, 1.3))
+            duration = min(duration, slot - 1)
+            offset = rng.randint(0, slot - duration - 1)
+            start = datetime.combine(day, datetime.min.time()) + timedelta(
+                hours=DAY_START_HOUR, seconds=index * slot + offset
+            )
+            planned.append({
+                'user_id': user_id, 'full_name': full_name, 'chat_id': chat_id,
+                'action': action, 'limit': limit, 'start': start, 'duration': duration
+            })
+    return planned
+
+
+def expected_warnings(planned, warnings):
+    """Warnings that must fire, as a Counter of (user name, seconds left, due time)."""
+    expected = Counter()
+    for activity in planned:
+        deadline = activity['start'] + timedelta(seconds=activity['limit'])
+        for seconds_left in warnings + (0,):
+            # A warning due at or before the check-out fires first
+            if activity['duration'] >= activity['limit'] - seconds_left:
+                expected[(activity['full_name'], seconds_left, deadline - timedelta(seconds=seconds_left))] += 1
+    return expected
+
+
+def count_lines(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return sum(1 for line in f if line.strip())
+    except FileNotFoundError:
+        return 0
+
+
+async def simulate(bot, args):
+    rng = random.Random(args.seed)
+    day = date.fromisoformat(args.date) if args.date else date.today()
+    day_str = day.strftime("%Y%m%d")
+    clock = bot.VirtualClock(datetime.combine(day, datetime.min.time()))
+    bot.clock = clock
+
+    stub = StubBot()
+    context = SimpleNamespace(bot=stub, args=[])
+    members = [(1000 + i, f'User {i}', -100 - (i % args.groups)) for i in range(args.users)]
+    for group_index in range(args.groups):
+        bot.group_settings[-100 - group_index] = {
+            'is_setup': True, 'group_name': f'Group {group_index}',
+            'admin_ids': [ADMIN_ID], 'superadmin_ids': [], 'report_group_id': -900 - group_index
+        }
+    planned = build_schedule(rng, list(bot.TIME_LIMITS), bot.TIME_LIMITS, members, args.activities, day)
+
+    fired = Counter()
+    send_warning = bot.outbound_sender.send_warning
+
+    def record_warning(chat_id, seconds_left, user_name, *rest, **kwargs):
+        fired[(user_name, seconds_left, clock.now())] += 1
+        send_warning(chat_id, seconds_left, user_name, *rest, **kwargs)
+
+    bot.outbound_sender.send_warning = record_warning
+    bot.outbound_sender.start(stub)
+    bot.countdown_scheduler.start()
+
+    presses = []
+    for activity in planned:
+        presses.append((activity['start'], 0, activity, activity['action']))
+        presses.append((activity['start'] + timedelta(seconds=activity['duration']), 1, activity, '🔙 Quay về'))
+    presses.sort(key=lambda press: (press[0], press[1], press[2]['user_id']))
+
+    latencies = []
+    started = time.perf_counter()
+    for when, _, activity, text in presses:
+        await clock.advance_to(when)
+        update = make_update(stub, activity['user_id'], activity['full_name'], activity['chat_id'], text)
+        press_started = time.perf_counter()
+        await bot.handle_activity_button(update, context)
+        latencies.append(time.perf_counter() - press_started)
+    day_elapsed = time.perf_counter() - started
+
+    report_sent_before = stub.sent
+    await clock.advance_to(datetime.combine(day, datetime.min.time()).replace(
+        hour=REPORT_TIME[0], minute=REPORT_TIME[1], second=REPORT_TIME[2]))
+    report_started = time.perf_counter()
+    await bot.send_daily_reports_job(context)
+    report_elapsed = time.perf_counter() - report_started
+    reports_sent = stub.sent - report_sent_before
+
+    # Log and daily totals are checked before midnight moves them to the archive
+    results = {'checks': []}
+
+    def check(name, ok, detail=''):
+        results['checks'].append({'name': name, 'ok': bool(ok), 'detail': detail})
+
+    expected = expected_warnings(planned, bot.COUNTDOWN_WARNINGS)
+    check('countdown warnings fire exactly when due', fired == expected,
+          f'expected {sum(expected.values())}, fired {sum(fired.values())}, '
+          f'missing {sum((expected - fired).values())}, unexpected {sum((fired - expected).values())}')
+
+    await bot.persistence_writer.drain()
+    rows = []
+    for group_index in range(args.groups):
+        rows.extend(bot.query_group_activities(-100 - group_index, day_str))
+    expected_violations = sum(1 for a in planned if a['duration'] > a['limit'])
+    check('one log row per check-out', len(rows) == len(planned), f'{len(rows)} rows for {len(planned)} activities')
+    check('violation flags', sum(1 for row in rows if row['Vi phạm'] == 'Có') == expected_violations,
+          f'{expected_violations} violations expected')
+
+    stats_ok = True
+    per_user = Counter(a['user_id'] for a in planned)
+    per_user_violations = Counter(a['user_id'] for a in planned if a['duration'] > a['limit'])
+    for user_id, _, _ in members:
+        stats = bot.daily_stats.get((user_id, day_str), bot.EMPTY_DAILY_STATS)
+        if stats['activity_count'] != per_user[user_id] or stats['violation_count'] != per_user_violations[user_id]:
+            stats_ok = False
+    check('daily totals', stats_ok)
+    check('one report per group', reports_sent == args.groups, f'{reports_sent} reports sent')
+
+    next_day = datetime.combine(day + timedelta(days=1), datetime.min.time())
+    await clock.advance_to(next_day.replace(hour=ARCHIVE_TIME[0], minute=ARCHIVE_TIME[1], second=ARCHIVE_TIME[2]))
+    await bot.archive_old_activities_job(context)
+    await clock.advance_to(next_day.replace(hour=ROLLUP_TIME[0], minute=ROLLUP_TIME[1], second=ROLLUP_TIME[2]))
+    await bot.write_daily_rollups_job(context)
+    await bot.persistence_writer.drain()
+
+    remaining = sum(
+        1 for user_id, _, _ in members for activity in bot.user_states[user_id]['activities']
+        if bot.get_activity_date(activity) == day_str
+    )
+    check('midnight moves the day out of memory', remaining == 0, f'{remaining} activities left')
+    if bot.sqlite_storage is None:
+        archived = count_lines(bot.get_archive_filename(day_str))
+        check('archive holds the day', archived == len(planned), f'{archived} archived')
+    rolled_up = sum(
+        row[3]
+        for group_index in range(args.groups)
+        for row in (bot.load_daily_rollup(-100 - group_index, day_str) or {'rows': []})['rows']
+    )
+    check('rollups hold the day', rolled_up == len(planned), f'{rolled_up} activities in rollups')
+
+    # A check-out after midnight belongs to the new day for the log, the totals and /report
+    real_clock = bot.Clock()
+    drift = abs(real_clock.now() - datetime.now(bot.REPORT_TIMEZONE).replace(tzinfo=None))
+    check(f'real clock follows REPORT_TIMEZONE (server timezone {time.tzname[0]})',
+          drift < timedelta(seconds=5) and real_clock.now().strftime("%Y%m%d") == real_clock.today_str(),
+          f'{drift.total_seconds():.0f}s off')
+    user_id, full_name, chat_id = members[0]
+    next_str = next_day.strftime("%Y%m%d")
+    await clock.advance_to(next_day.replace(hour=1))
+    await bot.handle_activity_button(make_update(stub, user_id, full_name, chat_id, planned[0]['action']), context)
+    await clock.advance(300)
+    await bot.handle_activity_button(make_update(stub, user_id, full_name, chat_id, '🔙 Quay về'), context)
+    await bot.persistence_writer.drain()
+    night_rows = len(bot.query_group_activities(chat_id, next_str))
+    night_stats = bot.daily_stats.get((user_id, next_str), bot.EMPTY_DAILY_STATS)['activity_count']
+    check('check-out after midnight goes to the new day', night_rows == 1 and night_stats == 1,
+          f'{night_rows} log rows, {night_stats} in daily totals')
+    documents_before = stub.documents
+    for report_args in ([], [next_day.strftime('%d/%m/%Y')]):
+        await bot.report(make_update(stub, ADMIN_ID, 'Admin', chat_id, '/report'), SimpleNamespace(bot=stub, args=report_args))
+    check('/report finds the new day', stub.documents - documents_before == 2,
+          f'{stub.documents - documents_before} of 2 reports sent')
+
+    # Let queued alerts drain
+    await clock.advance(3600)
+    await bot.countdown_scheduler.stop()
+    await bot.outbound_sender.stop()
+    bot.shutdown_render_pool()
+
+    results.update({
+        'users': args.users,
+        'groups': args.groups,
+        'activities': len(planned),
+        'presses': len(presses),
+        'simulated_hours': (clock.now() - clock.start).total_seconds() / 3600,
+        'day_wall_seconds': day_elapsed,
+        'presses_per_second': len(presses) / day_elapsed if day_elapsed else 0.0,
+        'press_p50_ms': percentile(latencies, 0.50) * 1000,
+        'press_p99_ms': percentile(latencies, 0.99) * 1000,
+        'warnings_fired': sum(fired.values()),
+        'alerts_sent': bot.metrics.counters.get(('bot_outbound_sent_total', ()), 0),
+        'report_seconds': report_elapsed,
+    })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=4)
+    parser.add_argument('--activities', type=int, default=8, help='activities per user during the day')
+    parser.add_argument('--date', help='simulated day (YYYY-MM-DD), today by default')
+    parser.add_argument('--backend', choices=('files', 'sqlite'), default='files')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server-tz', default='UTC', help='timezone the process runs in (TZ), where the platform can set it')
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON')
+    args = parser.parse_args()
+
+    # The bot must not depend on the server's timezone
+    if hasattr(time, 'tzset'):
+        os.environ['TZ'] = args.server_tz
+        time.tzset()
+
+    with tempfile.TemporaryDirectory(prefix='bot-sim-') as workdir:
+        # bot.load_state() reads its state from the working directory
+        os.environ['STORAGE_BACKEND'] = args.backend
+        os.environ['REPORTS_DIR'] = os.path.join(workdir, 'reports')
+        os.environ['SQLITE_DB_FILE'] = os.path.join(workdir, 'bot.db')
+        os.chdir(workdir)
+        sys.path.insert(0, BOT_DIR)
+        import bot
+        bot.load_state()
+
+        wall_started = time.perf_counter()
+        results = asyncio.run(simulate(bot, args))
+        results['wall_seconds'] = time.perf_counter() - wall_started
+        bot.persistence_writer.stop()
+        os.chdir(BOT_DIR)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for item in results['checks']:
+            print(f"{'PASS' if item['ok'] else 'FAIL'}  {item['name']}" + (f"  ({item['detail']})" if item['detail'] else ''))
+        print(
+            f"\n{results['users']} users, {results['groups']} groups, {results['activities']} activities, "
+            f"{results['simulated_hours']:.1f} simulated hours in {results['wall_seconds']:.1f}s\n"
+            f"presses: {results['presses']} ({results['presses_per_second']:.0f}/s, "
+            f"p50 {results['press_p50_ms']:.2f} ms, p99 {results['press_p99_ms']:.2f} ms)\n"
+            f"countdown warnings fired: {results['warnings_fired']}, alerts sent: {results['alerts_sent']:.0f}\n"
+            f"nightly report job: {results['report_seconds']:.2f}s"
+        )
+    sys.exit(0 if all(item['ok'] for item in results['checks']) else 1)
+
+
+if __name__ == '__main__':
+    main()